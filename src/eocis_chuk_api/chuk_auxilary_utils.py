@@ -18,14 +18,46 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import abc
+import functools
 
 import xarray as xr
 import numpy as np
 import fnmatch
+import re
+
+from .chuk_file_cache import open_dataset_cached
+from .chuk_mask_kernels import build_lut, lookup_mask
+
+
+def _isin_mask(a:np.ndarray, values:np.ndarray) -> np.ndarray:
+    # map each flag value to True/False according to whether it is one of the selected values
+    return np.isin(a, values)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_pattern(pattern:str) -> re.Pattern:
+    # compile each glob pattern once, shared between all masks
+    return re.compile(fnmatch.translate(pattern))
+
+
+def _packed_combine_kernel(*arrays:np.ndarray, operator:str="or") -> np.ndarray:
+    # pack up to 8 boolean masks into the bits of one uint8 value per cell, then test the packed values
+    # apply_ufunc does not broadcast the blocks, masks may have fewer dimensions (or size 1 dimensions)
+    packed = np.zeros(np.broadcast_shapes(*map(np.shape, arrays)), dtype=np.uint8)
+    for (bit, a) in enumerate(arrays):
+        packed |= np.left_shift(np.asarray(a, dtype=bool).view(np.uint8), np.uint8(bit))
+    if operator == "or":
+        return packed != 0
+    else:
+        return packed == (1 << len(arrays)) - 1
 
 
 class Mask(abc.ABC):
 
+    # the array that the cached (count, size) statistics were computed from, and the statistics
+    _stats_array = None
+    _stats_result = None
+
     def __init__(self):
         """
         Abstract Base Class for masks, do not instantiate directly
@@ -64,27 +96,79 @@ class Mask(abc.ABC):
         """
         return CHUKAuxilaryDataCombinedMask(self, operator="not")
 
-    def count(self) -> int:
+    def count(self, num_workers:int=None) -> int:
         """
         Count the number of True values in this mask
 
+        Args:
+            num_workers: the number of threads to use when evaluating the mask, defaults to the dask default
+
         Returns:
             the total number of True values
         """
-        return int(self.to_array().sum())
+        return self._stats(num_workers)[0]
 
-    def fraction(self) -> float:
+    def fraction(self, num_workers:int=None) -> float:
         """
         Calculate the fraction of values that are True in this mask
 
+        Args:
+            num_workers: the number of threads to use when evaluating the mask, defaults to the dask default
+
         Returns:
             the fraction of values that are True
         """
+        (count, size) = self._stats(num_workers)
+        return count / size
+
+    def count_and_fraction(self, num_workers:int=None) -> (int, float):
+        """
+        Count the number of True values in this mask and calculate the fraction of values that are True
+
+        Args:
+            num_workers: the number of threads to use when evaluating the mask, defaults to the dask default
+
+        Returns:
+            2-tuple (count, fraction), computed with a single pass over the mask
+        """
+        (count, size) = self._stats(num_workers)
+        return count, count / size
+
+    def _stats(self, num_workers:int=None) -> (int, int):
+        # compute (number of True values, number of values), reusing the last result while
+        # to_array() keeps returning the same (cached) array
         m = self.to_array()
-        count = 1
-        for d in m.shape:
-            count *= d
-        return int(m.sum()) / count
+        if self._stats_array is not m:
+            # count_nonzero avoids the int64 accumulator used by sum, and is dispatched to dask for lazy masks
+            total = np.count_nonzero(m.data)
+            if hasattr(total, "compute"):
+                if num_workers is not None:
+                    total = total.compute(scheduler="threads", num_workers=num_workers)
+                else:
+                    total = total.compute()
+            self._stats_result = (int(total), m.size)
+            self._stats_array = m
+        return self._stats_result
+
+    def invalidate(self):
+        """
+        Discard any cached result, so that the mask is re-evaluated on the next call to to_array()
+        """
+        self._stats_array = None
+        self._stats_result = None
+
+    def persist(self) -> "Mask":
+        """
+        Evaluate this mask and keep the result in memory (or on the dask cluster), see xarray.DataArray.persist
+
+        Returns:
+            this mask
+
+        Notes:
+            the base implementation does nothing, as it has no way to reuse the result.  Sub-classes which cache the
+            result of to_array() override this to persist it, masks whose data is already in memory need not.
+        """
+        return self
 
     @abc.abstractmethod
     def to_array(self) -> xr.DataArray:
@@ -99,7 +183,7 @@ class Mask(abc.ABC):
 
 class CHUKAuxilaryDataMask(Mask):
 
-    def __init__(self, dataset_name:str, variable_name:str, include_missing:bool=False):
+    def __init__(self, dataset_name:str, variable_name:str, include_missing:bool=False, chunks:[str,dict]="auto"):
         """
         Construct a mask associated with a particular dataset
 
@@ -107,17 +191,25 @@ class CHUKAuxilaryDataMask(Mask):
             dataset_name: the name of the dataset
             variable_name: the name of the variable in the dataset to use to construct the mask
             include_missing: whether to also include missing data values (eg NaN) in the mask
+            chunks: chunking passed to xarray.open_dataset, the variable is opened lazily as a dask array
+
+        Notes:
+            the mask is evaluated lazily, call .compute() or .persist() on the result of to_array() to load it
+            masks created from the same file share a single opened dataset
         """
         self.dataset_name = dataset_name
         self.variable_name = variable_name
-        self.da = xr.open_dataset(dataset_name)[variable_name]
+        # keep a reference to the shared dataset, which keeps it open while this mask is in use
+        self.ds = open_dataset_cached(dataset_name, chunks=chunks, decode_coords="all")
+        self.da = self.ds[variable_name]
         meanings = self.da.attrs["flag_meanings"].split(" ")
-        values = self.da.attrs["flag_values"]
-        self.value_lookup = {}
-        for (meaning, value) in zip(meanings, values):
-            self.value_lookup[meaning] = value
+        # flag_values may be a numpy array, a list or a single scalar
+        values = np.atleast_1d(self.da.attrs["flag_values"]).tolist()
+        self.value_lookup = dict(zip(meanings, map(int, values)))
         self.mask_values = []
+        self.resolved_values = set()
         self.cached_result = None
+        self.cached_selected_values = None
         self.include_missing = include_missing
 
     def get_all_mask_values(self) -> list[str]:
@@ -136,10 +228,12 @@ class CHUKAuxilaryDataMask(Mask):
         Returns:
              a list of values included in this mask
         """
-        keys = []
-        for mask_value in self.mask_values:
-            keys += self.__get_matching_keys(mask_value)
-        return keys
+        if self.cached_selected_values is None:
+            keys = []
+            for mask_value in self.mask_values:
+                keys += self.__get_matching_keys(mask_value)
+            self.cached_selected_values = keys
+        return list(self.cached_selected_values)
 
     def add_mask_value(self, mask_value: str):
         """
@@ -154,33 +248,66 @@ class CHUKAuxilaryDataMask(Mask):
         if len(matching_keys) == 0:
             raise ValueError(f"Value {mask_value} does not match any values {','.join(self.value_lookup.keys())}")
         self.cached_result = None
+        self.cached_selected_values = None
         self.mask_values.append(mask_value)
+        self.resolved_values.update(self.value_lookup[key] for key in matching_keys)
         return matching_keys
 
+    def invalidate(self):
+        """
+        Discard the cached mask, so that it is re-evaluated on the next call to to_array()
+        """
+        super().invalidate()
+        self.cached_result = None
+
+    def persist(self) -> "CHUKAuxilaryDataMask":
+        """
+        Read the auxilary variable into memory (or onto the dask cluster), so that it is read only once
+        however many times this mask is evaluated or combined with other masks
+
+        Returns:
+            this mask
+
+        Examples:
+            >>> mask = CHUKAuxilaryUtils.create_mask("landcover.nc", "land_cover", "*woodland").persist()
+        """
+        self.da = self.da.persist()
+        self.cached_result = None
+        return self
+
     def to_array(self) -> xr.DataArray:
         """
-        Obtain the evaluated mask values
+        Obtain the mask values
+
         Returns:
-            an xarray DataArray object
+            an xarray DataArray object, backed by a dask array which is evaluated on demand
         """
         if self.cached_result is None:
-            filter_keys = []
-            for mask_value in self.mask_values:
-                filter_keys += self.__get_matching_keys(mask_value)
-            filter_values = [self.value_lookup[key] for key in filter_keys]
-            self.cached_result = xr.where(self.da.isin(filter_values), True, False)
+            dtype = self.da.dtype
+            filter_values = np.fromiter(self.resolved_values, dtype=dtype, count=len(self.resolved_values))
+            if len(filter_values) == 0:
+                # no values selected, no need to scan the data
+                result = xr.zeros_like(self.da, dtype=bool)
+            elif dtype.kind in "iu" and dtype.itemsize <= 2:
+                # small integer flags - replace isin with a lookup table indexed by the (unsigned) flag value
+                result = xr.apply_ufunc(lookup_mask, self.da, kwargs={"lut": build_lut(filter_values)},
+                                        dask="parallelized", output_dtypes=[bool])
+            else:
+                result = xr.apply_ufunc(_isin_mask, self.da, kwargs={"values": filter_values},
+                                        dask="parallelized", output_dtypes=[bool])
             if self.include_missing:
-                self.cached_result = xr.where(np.isnan(self.da),True,self.cached_result)
+                result = result | self.da.isnull()
+            self.cached_result = result
         return self.cached_result
 
     def __get_matching_keys(self, value_or_pattern):
         if value_or_pattern in self.value_lookup:
             return [value_or_pattern]
-        matches = []
-        for key in self.value_lookup:
-            if fnmatch.fnmatch(key, value_or_pattern):
-                matches.append(key)
-        return matches
+        if not any(c in value_or_pattern for c in "*?["):
+            # not a pattern and not an exact match
+            return []
+        pattern = _compile_pattern(value_or_pattern)
+        return [key for key in self.value_lookup if pattern.match(key)]
 
 
 class CHUKAuxilaryDataCombinedMask(Mask):
@@ -204,25 +331,62 @@ class CHUKAuxilaryDataCombinedMask(Mask):
             raise ValueError("only one mask can be supplied for the not operator")
         self.input_masks = masks
         self.operator = operator
+        self.cached_inputs = None
+        self.cached_result = None
+
+    def invalidate(self):
+        """
+        Discard the cached result of this mask and of all the masks it is derived from
+        """
+        super().invalidate()
+        self.cached_inputs = None
+        self.cached_result = None
+        for m in self.input_masks:
+            m.invalidate()
+
+    def persist(self) -> "CHUKAuxilaryDataCombinedMask":
+        """
+        Evaluate this mask and keep the result in memory (or on the dask cluster)
+
+        Returns:
+            this mask
+        """
+        self.cached_result = self.to_array().persist()
+        return self
 
     def to_array(self):
+        arrays = [m.to_array() for m in self.input_masks]
 
-        if self.operator == "not":
-            m = self.input_masks[0].to_array()
-            return xr.where(m,False,True)
+        # reuse the previous result unless any of the input masks has been re-evaluated
+        if self.cached_result is not None and all(a is b for (a, b) in zip(arrays, self.cached_inputs)):
+            return self.cached_result
 
-        stacked = xr.concat([m.to_array() for m in self.input_masks], "layer")
+        if self.operator == "not":
+            result = ~arrays[0]
+        elif len(arrays) <= 8:
+            result = CHUKAuxilaryDataCombinedMask._packed_combine(arrays, self.operator)
+        elif self.operator == "or":
+            # combine pairwise rather than stacking all the input masks into one array
+            result = functools.reduce(np.logical_or, arrays)
+        else:
+            result = functools.reduce(np.logical_and, arrays)
+
+        self.cached_inputs = arrays
+        self.cached_result = result
+        return result
 
-        if self.operator == "or":
-            return stacked.any(dim="layer")
-        elif self.operator == "and":
-            return stacked.all(dim="layer")
+    @staticmethod
+    def _packed_combine(arrays:list[xr.DataArray], operator:str) -> xr.DataArray:
+        # evaluate "and" / "or" of up to 8 masks in a single pass over each block
+        return xr.apply_ufunc(_packed_combine_kernel, *arrays, kwargs={"operator": operator},
+                              dask="parallelized", output_dtypes=[bool])
 
 
 class CHUKAuxilaryUtils:
 
     @staticmethod
-    def create_mask(dataset_path:str, variable:str, mask_values:[str,list[str]], include_missing:bool=False) -> CHUKAuxilaryDataMask:
+    def create_mask(dataset_path:str, variable:str, mask_values:[str,list[str]], include_missing:bool=False,
+                    chunks:[str,dict]="auto") -> CHUKAuxilaryDataMask:
         """
         Create a mask
 
@@ -231,11 +395,12 @@ class CHUKAuxilaryUtils:
             variable: the variable in the file to use in the mask
             mask_values: a string or list of strings
             include_missing: whether to include missing data values in the mask or not
+            chunks: chunking used when opening the dataset lazily, see xarray.open_dataset
 
         Returns:
             A mask object containing of True or False values for every cell
         """
-        mask = CHUKAuxilaryDataMask(dataset_path, variable)
+        mask = CHUKAuxilaryDataMask(dataset_path, variable, include_missing=include_missing, chunks=chunks)
         if isinstance(mask_values, str):
             mask_values = [mask_values]
         for mask_value in mask_values:
@@ -280,3 +445,37 @@ class CHUKAuxilaryUtils:
     @staticmethod
     def not_mask(mask:Mask):
         return mask.not_mask()
+
+    @staticmethod
+    def masked_mean(data_array:xr.DataArray, mask:Mask) -> float:
+        """
+        Calculate the mean of the values in a CHUK variable where a mask is True, ignoring missing (NaN) values
+
+        Args:
+            data_array: the variable, on the same (y,x) grid as the mask and possibly with other dimensions
+            mask: the mask selecting the cells to include
+
+        Returns:
+            the mean value, or NaN if the mask selects no (non-missing) values
+
+        Raises:
+            ValueError: if the variable and the mask are not on the same grid, for example if the variable has been
+                        cropped or sampled (where both have x and y coordinates, these must be identical)
+
+        Notes:
+            where both are on the same grid, this is equivalent to data_array.where(mask.to_array()).mean(skipna=True),
+            but only the selected values are reduced rather than a full size copy of the variable with NaN outside
+            the mask
+        """
+        m = mask.to_array()
+        # the mask is applied by position, so check that the cells of the variable and the mask correspond
+        try:
+            (m, data_array) = xr.align(m, data_array, join="exact")
+        except ValueError as ex:
+            raise ValueError("data_array and mask must be on the same grid, with identical x and y coordinates") \
+                from ex
+        if m.dims != data_array.dims:
+            m = m.broadcast_like(data_array).transpose(*data_array.dims)
+        # boolean indexing and nanmean are dispatched to dask for lazy arrays
+        selected = data_array.data[m.data]
+        return float(np.nanmean(selected, dtype=np.float64))
@@ -1,7 +1,5 @@
 # -*- coding: utf-8 -*-
-import datetime
 
-import numpy as np
 #     API for managing EOCIS-CHUK data
 #
 #     Copyright (C) 2023  EOCIS and National Centre for Earth Observation (NCEO)
@@ -19,9 +17,12 @@ import numpy as np
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import numpy as np
 import xarray as xr
 import xarray
 from .chuk_metadata import CHUKMetadata
+from .chuk_file_cache import open_dataset_cached, close_cached_dataset, clear_dataset_cache, READ_LOCK
 
 
 class CHUKDataSetUtils:
@@ -63,22 +64,146 @@ class CHUKDataSetUtils:
 
     """
 
-    def __init__(self, chuk_grid_path: str):
+    # global attributes set by create_new_dataset, in output order
+    GLOBAL_ATTRIBUTES = (
+        "title",
+        "institution",
+        "source",
+        "history",
+        "references",
+        "tracking_id",
+        "Conventions",
+        "product_version",
+        "format_version",
+        "summary",
+        "keywords",
+        "id",
+        "naming_authority",
+        "keywords_vocabulary",
+        "cdm_data_type",
+        "comment",
+        "date_created",
+        "creator_name",
+        "creator_url",
+        "creator_email",
+        "project",
+        "geospatial_lat_min",
+        "geospatial_lat_max",
+        "geospatial_lon_min",
+        "geospatial_lon_max",
+        "geospatial_vertical_min",
+        "geospatial_vertical_max",
+        "time_coverage_start",
+        "time_coverage_end",
+        "time_coverage_duration",
+        "time_coverage_resolution",
+        "standard_name_vocabulary",
+        "license",
+        "platform",
+        "sensor",
+        "spatial_resolution",
+        "geospatial_lat_units",
+        "geospatial_lon_units",
+        "geospatial_lon_resolution",
+        "geospatial_lat_resolution",
+        "key_variables",
+        "acknowledgement",
+        "publisher_name",
+        "publisher_url",
+        "publisher_email"
+    )
+
+    # global attributes which create_new_dataset requires to be non-empty
+    REQUIRED_GLOBAL_ATTRIBUTES = frozenset({"title", "institution", "tracking_id", "product_version"})
+
+    # variables copied from the grid file
+    GRID_VARIABLES = frozenset({"x", "y", "x_bnds", "y_bnds", "crsOSGB", "lon", "lat", "lon_bnds", "lat_bnds"})
+
+    # encoding settings describing how a variable is packed on disk, which save() keeps from each variable's encoding
+    PACKING_ENCODINGS = ("dtype", "scale_factor", "add_offset", "_FillValue")
+
+    # the default chunk sizes and zlib compression level used by save() and create_encodings()
+    DEFAULT_X_CHUNK_SIZE = 1000
+    DEFAULT_Y_CHUNK_SIZE = 1000
+    DEFAULT_TIME_CHUNK_SIZE = 1
+    DEFAULT_COMPLEVEL = 5
+
+    # codecs other than zlib which save() can use, and the netCDF4 module flag showing whether each is supported
+    NETCDF4_CODECS = {
+        "zstd": "__has_zstandard_support__",
+        "bzip2": "__has_bzip2_support__",
+        "szip": "__has_szip_support__",
+        "blosc_lz": "__has_blosc_support__",
+        "blosc_lz4": "__has_blosc_support__",
+        "blosc_lz4hc": "__has_blosc_support__",
+        "blosc_zlib": "__has_blosc_support__",
+        "blosc_zstd": "__has_blosc_support__"
+    }
+
+    def __init__(self, chuk_grid_path: [str, xarray.Dataset]):
         """
         Initialise an instance with the path to the CHUK grid file
 
         Args:
-            chuk_grid_path: path to a grid file
+            chuk_grid_path: path to a grid file, or a grid dataset which has already been opened
 
         Notes:
             grid files can be obtained from https://gws-access.jasmin.ac.uk/public/nceo_uor/eocis-chuk/
+            the grid file is opened lazily, using its on-disk chunking, and shared between instances created with the same path
 
         Examples:
             >>> from eocis_chuk_api import CHUKDataSetUtils
             >>> utils = CHUKDataSetUtils("EOCIS-CHUK-GRID-100M-v0.4.nc")
         """
-        self.chuk_grid_ds = xr.open_dataset(chuk_grid_path)
-        self.grid_resolution = int(self.chuk_grid_ds.x.data[1]) - int(self.chuk_grid_ds.x.data[0])
+        if isinstance(chuk_grid_path, xarray.Dataset):
+            self.chuk_grid_ds = chuk_grid_path
+        else:
+            self.chuk_grid_ds = open_dataset_cached(chuk_grid_path, chunks={})
+        x0, x1 = self.chuk_grid_ds["x"].isel(x=slice(0, 2)).values
+        self.grid_resolution = int(x1) - int(x0)
+        self._expected_sizes = {"x": int(self.chuk_grid_ds.sizes["x"]), "y": int(self.chuk_grid_ds.sizes["y"])}
+        self._expected_size_values = tuple(self._expected_sizes.values())
+        # keep references to the grid lat/lon arrays, which are added to datasets on request
+        self._lat = self.chuk_grid_ds["lat"]
+        self._lon = self.chuk_grid_ds["lon"]
+        self._lat_bnds = self.chuk_grid_ds["lat_bnds"] if "lat_bnds" in self.chuk_grid_ds else None
+        self._lon_bnds = self.chuk_grid_ds["lon_bnds"] if "lon_bnds" in self.chuk_grid_ds else None
+        self._grid_shape = tuple(self._lat.shape)
+        self._grid_variables = {name: self.chuk_grid_ds[name]
+                                for name in CHUKDataSetUtils.GRID_VARIABLES if name in self.chuk_grid_ds.variables}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Release this instance's references to the grid file, the instance cannot be used afterwards
+
+        Notes:
+            the grid dataset is shared with other instances opened on the same path (or may have been opened by the
+            caller), so it is not closed here
+
+        Examples:
+            >>> from eocis_chuk_api import CHUKDataSetUtils
+            >>> with CHUKDataSetUtils("EOCIS-CHUK-GRID-100M-v0.4.nc") as utils:
+            >>>     ds = utils.load("EOCIS-CHUK-L4-SQUIRRELPOP-MERGED-20231204-v0.1.nc", add_latlon=True)
+        """
+        self.chuk_grid_ds = None
+        self._lat = self._lon = self._lat_bnds = self._lon_bnds = None
+        self._grid_variables = {}
+
+    @staticmethod
+    def clear_grid_cache():
+        """
+        Forget the grid files shared between instances, so that new instances re-open them
+
+        Notes:
+            grid files which are rewritten are re-opened automatically, this is mainly useful in tests
+        """
+        clear_dataset_cache()
 
     def get_grid_latlons(self) -> (xarray.DataArray, xarray.DataArray):
         """
@@ -87,7 +212,29 @@ class CHUKDataSetUtils:
         Returns:
             2-tuple containing xarray.DataArray objects (lats,lons)
         """
-        return (self.chuk_grid_ds.lat, self.chuk_grid_ds.lon)
+        return (self._lat, self._lon)
+
+    def persist_grid_latlons(self) -> "CHUKDataSetUtils":
+        """
+        Read the grid lat/lon arrays (and their bounds, if present) into memory, or onto the dask cluster, so that
+        they are read from the grid file only once however many times they are used
+
+        Returns:
+            this instance
+
+        Notes:
+            by default the arrays are read lazily from the grid file each time they are computed, which uses less
+            memory when they are only needed once (for the 100m grid, lat and lon are around 1GB each)
+        """
+        names = [name for name in ("lat", "lon", "lat_bnds", "lon_bnds") if name in self._grid_variables]
+        persisted = dict(zip(names, xarray.Dataset({name: self._grid_variables[name] for name in names}).persist()
+                             .data_vars.values()))
+        self._grid_variables.update(persisted)
+        self._lat = persisted["lat"]
+        self._lon = persisted["lon"]
+        self._lat_bnds = persisted.get("lat_bnds")
+        self._lon_bnds = persisted.get("lon_bnds")
+        return self
 
     def get_grid_shape(self) -> (int, int):
         """
@@ -96,7 +243,7 @@ class CHUKDataSetUtils:
         Returns:
             2-tuple containing the grid (height, width)
         """
-        return self.chuk_grid_ds.lat.shape
+        return self._grid_shape
 
     def create_filename(self, project: str, processing_level: str, product_type: str, product_string: str,
                         datetime: str, version: str, additional_segregator: str = None, suffix: str = ".nc") -> str:
@@ -172,7 +319,7 @@ class CHUKDataSetUtils:
         Create a new CHUK dataset with expected global attributes.
 
         Args:
-            include_lon_lat: True if lon and lat 2d variables should be included
+            include_lon_lat: True if lon and lat 2d variables should be included (see save for how they are stored)
             title: a title for the dataset
             institution: Succinct description of the dataset
             source: Comma separated list of original data sources (+DOIs if available)
@@ -219,55 +366,67 @@ class CHUKDataSetUtils:
 
         Returns:
             An xarray.Dataset object
-        """
 
-        attrs = {}
-        self.__extend_attrs(attrs, "title", title, required=True)
-        self.__extend_attrs(attrs, "institution", institution, required=True)
-        self.__extend_attrs(attrs, "source", source)
-        self.__extend_attrs(attrs, "history", history)
-        self.__extend_attrs(attrs, "references", references)
-        self.__extend_attrs(attrs, "tracking_id", tracking_id, required=True),
-        self.__extend_attrs(attrs, "Conventions", Conventions)
-        self.__extend_attrs(attrs, "product_version", product_version, required=True)
-        self.__extend_attrs(attrs, "format_version", format_version)
-        self.__extend_attrs(attrs, "summary", summary)
-        self.__extend_attrs(attrs, "keywords", keywords)
-        self.__extend_attrs(attrs, "id", id),
-        self.__extend_attrs(attrs, "naming_authority", naming_authority),
-        self.__extend_attrs(attrs, "keywords_vocabulary", keywords_vocabulary, required=False),
-        self.__extend_attrs(attrs, "cdm_data_type", cdm_data_type),
-        self.__extend_attrs(attrs, "comment", comment),
-        self.__extend_attrs(attrs, "date_created", date_created),
-        self.__extend_attrs(attrs, "creator_name", creator_name),
-        self.__extend_attrs(attrs, "creator_url", creator_url),
-        self.__extend_attrs(attrs, "creator_email", creator_email),
-        self.__extend_attrs(attrs, "project", project),
-        self.__extend_attrs(attrs, "geospatial_lat_min", geospatial_lat_min),
-        self.__extend_attrs(attrs, "geospatial_lat_max", geospatial_lat_max),
-        self.__extend_attrs(attrs, "geospatial_lon_min", geospatial_lon_min),
-        self.__extend_attrs(attrs, "geospatial_lon_max", geospatial_lon_max),
-        self.__extend_attrs(attrs, "geospatial_vertical_min", geospatial_vertical_min),
-        self.__extend_attrs(attrs, "geospatial_vertical_max", geospatial_vertical_max),
-        self.__extend_attrs(attrs, "time_coverage_start", time_coverage_start),
-        self.__extend_attrs(attrs, "time_coverage_end", time_coverage_end),
-        self.__extend_attrs(attrs, "time_coverage_duration", time_coverage_duration),
-        self.__extend_attrs(attrs, "time_coverage_resolution", time_coverage_resolution),
-        self.__extend_attrs(attrs, "standard_name_vocabulary", standard_name_vocabulary),
-        self.__extend_attrs(attrs, "license", license),
-        self.__extend_attrs(attrs, "platform", platform),
-        self.__extend_attrs(attrs, "sensor", sensor),
-        self.__extend_attrs(attrs, "spatial_resolution", spatial_resolution),
-        self.__extend_attrs(attrs, "geospatial_lat_units", geospatial_lat_units),
-        self.__extend_attrs(attrs, "geospatial_lon_units", geospatial_lon_units),
-        self.__extend_attrs(attrs, "geospatial_lon_resolution", geospatial_lon_resolution),
-        self.__extend_attrs(attrs, "geospatial_lat_resolution", geospatial_lat_resolution),
-        self.__extend_attrs(attrs, "key_variables", key_variables)
-        self.__extend_attrs(attrs, "acknowledgement", acknowledgement)
-        self.__extend_attrs(attrs, "publisher_name", publisher_name),
-        self.__extend_attrs(attrs, "publisher_url", publisher_url),
-        self.__extend_attrs(attrs, "publisher_email", publisher_email),
+        Raises:
+            ValueError: if any of title, institution, tracking_id or product_version are empty, or any attribute is None
+        """
 
+        # the global attributes passed as arguments, by name
+        values = {
+            "title": title,
+            "institution": institution,
+            "source": source,
+            "history": history,
+            "references": references,
+            "tracking_id": tracking_id,
+            "Conventions": Conventions,
+            "product_version": product_version,
+            "format_version": format_version,
+            "summary": summary,
+            "keywords": keywords,
+            "id": id,
+            "naming_authority": naming_authority,
+            "keywords_vocabulary": keywords_vocabulary,
+            "cdm_data_type": cdm_data_type,
+            "comment": comment,
+            "date_created": date_created,
+            "creator_name": creator_name,
+            "creator_url": creator_url,
+            "creator_email": creator_email,
+            "project": project,
+            "geospatial_lat_min": geospatial_lat_min,
+            "geospatial_lat_max": geospatial_lat_max,
+            "geospatial_lon_min": geospatial_lon_min,
+            "geospatial_lon_max": geospatial_lon_max,
+            "geospatial_vertical_min": geospatial_vertical_min,
+            "geospatial_vertical_max": geospatial_vertical_max,
+            "time_coverage_start": time_coverage_start,
+            "time_coverage_end": time_coverage_end,
+            "time_coverage_duration": time_coverage_duration,
+            "time_coverage_resolution": time_coverage_resolution,
+            "standard_name_vocabulary": standard_name_vocabulary,
+            "license": license,
+            "platform": platform,
+            "sensor": sensor,
+            "spatial_resolution": spatial_resolution,
+            "geospatial_lat_units": geospatial_lat_units,
+            "geospatial_lon_units": geospatial_lon_units,
+            "geospatial_lon_resolution": geospatial_lon_resolution,
+            "geospatial_lat_resolution": geospatial_lat_resolution,
+            "key_variables": key_variables,
+            "acknowledgement": acknowledgement,
+            "publisher_name": publisher_name,
+            "publisher_url": publisher_url,
+            "publisher_email": publisher_email
+        }
+        required = CHUKDataSetUtils.REQUIRED_GLOBAL_ATTRIBUTES
+        missing = [key for key in CHUKDataSetUtils.GLOBAL_ATTRIBUTES
+                   if values[key] is None or (values[key] == "" and key in required)]
+        if missing:
+            raise ValueError(f"attributes {', '.join(missing)} are required")
+
+        # empty attributes are left out
+        attrs = {key: values[key] for key in CHUKDataSetUtils.GLOBAL_ATTRIBUTES if values[key] != ""}
         attrs.update(other_attributes)
         ds = xr.Dataset(attrs=attrs)
         # copy the grid definition from the grid file
@@ -275,7 +434,7 @@ class CHUKDataSetUtils:
         if include_lon_lat:
             copyvars += ["lon", "lat"]
         for copyvar in copyvars:
-            ds[copyvar] = self.chuk_grid_ds[copyvar]
+            ds[copyvar] = self._grid_variables[copyvar]
 
         ds = ds.rio.write_crs("EPSG:27700", grid_mapping_name="crsOSGB")
 
@@ -299,108 +458,365 @@ class CHUKDataSetUtils:
             ValueError: if the data parameter does not match the expected shape
         """
         expected_shape = self.get_grid_shape()
-        if len(data.shape) == 2:
+        if data.ndim == 2 and data.shape == expected_shape:
             dims = ("y", "x")
-            if data.shape != expected_shape:
-                raise ValueError("Bad data shape, expecting: " + str(expected_shape) + " was: " + str(data.shape))
+        elif data.ndim == 3 and data.shape[1:] == expected_shape:
+            dims = ("time", "y", "x")
+        elif data.ndim == 3 and data.shape[:-1] == expected_shape:
+            dims = ("y", "x", "time")
         else:
-            if data.shape[1:] == expected_shape:
-                dims = ("time", "y", "x")
-            elif data.shape[1:] == expected_shape:
-                dims = ("y", "x", "time")
+            raise ValueError(f"Bad data shape, expecting: {expected_shape} was: {data.shape}")
 
-        attrs = {
-            "grid_mapping": "crsOSGB"
-        }
-        if standard_name is not None:
-            attrs["standard_name"] = standard_name
-        if long_name is not None:
-            attrs["long_name"] = long_name
-        if source is not None:
-            attrs["source"] = source
-        if units is not None:
-            attrs["units"] = units
-        attrs.update(other_attrs)
+        optional_attrs = (("standard_name", standard_name), ("long_name", long_name), ("source", source),
+                          ("units", units))
+        attrs = {"grid_mapping": "crsOSGB",
+                 **{name: value for (name, value) in optional_attrs if value is not None},
+                 **other_attrs}
 
         to_dataset[variable_name] = xr.DataArray(data=data, dims=dims, attrs=attrs)
 
-    def load(self, from_path: str, add_latlon: bool = False, add_latlon_bnds: bool = False) -> xarray.Dataset:
+    def load(self, from_path: [str, os.PathLike], add_latlon: bool = False, add_latlon_bnds: bool = False,
+             lazy_load: bool = True, chunks: [str, dict] = "auto", engine: str = None) -> xarray.Dataset:
         """
         Load a CHUK dataset from file and return a dataset
 
         Args:
-            from_path: path to a NetCDF4 file
+            from_path: path to a NetCDF4 file, or to a Zarr store if the path ends with .zarr
             add_latlon: add lon and lat 2D arrays to the dataset
             add_latlon_bnds: add lon_bnds and lat_bnds 2D arrays to the dataset
+            lazy_load: open the variables as dask arrays which are read on demand, set to False to read all data
+            chunks: the dask chunking used when lazy_load is True, pass {} to use the chunking of the file itself so
+                    that reading part of the data only reads the file chunks it overlaps.  "auto" chunks are
+                    multiples of the file chunks.
+            engine: the xarray engine used to read a NetCDF4 file, defaults to "netcdf4", "h5netcdf" can be used if
+                    it is installed
 
         Returns:
             A dataset containing the loaded CHUK data
         """
-        ds = xr.open_dataset(from_path, decode_coords="all")
+        if CHUKDataSetUtils.__is_zarr_path(from_path):
+            ds = xr.open_zarr(from_path, decode_coords="all", chunks=chunks if lazy_load else None)
+        else:
+            ds = xr.open_dataset(from_path, decode_coords="all", chunks=chunks if lazy_load else None, lock=READ_LOCK,
+                                 engine=engine)
 
         self.extend_latlon(ds, add_latlon=add_latlon, add_latlon_bnds=add_latlon_bnds)
 
+        if not lazy_load:
+            ds.load()
+
         return ds
 
-    def save(self, ds: xarray.Dataset, to_path: str, add_latlon: bool = False, add_latlon_bnds: bool = False,
-             x_chunk_size: int = 1000, y_chunk_size: int = 1000,
-             time_chunk_size: int = 1, custom_encodings: dict = {}, override_encodings: dict={}):
+    def save(self, ds: xarray.Dataset, to_path: [str, os.PathLike], add_latlon: bool = False,
+             add_latlon_bnds: bool = False,
+             x_chunk_size: int = DEFAULT_X_CHUNK_SIZE, y_chunk_size: int = DEFAULT_Y_CHUNK_SIZE,
+             time_chunk_size: int = DEFAULT_TIME_CHUNK_SIZE, custom_encodings: dict = {}, override_encodings: dict={},
+             compression: str = "zlib", complevel: int = DEFAULT_COMPLEVEL, shuffle: bool = True,
+             num_workers: int = None, engine: str = None, significant_digits: [int, dict] = None,
+             quantize_mode: str = "GranularBitRound", latlon_dtype: str = None, persist: bool = False):
         """
         Save a CHUK dataset to file, applying the standard chunking and compression
 
         Args:
             ds: an xarray dataset containing CHUK data
-            to_path: path to a NetCDF4 file
+            to_path: path to a NetCDF4 file.  Paths ending with .zarr are saved as a Zarr store using save_zarr, in
+                     which case the compression options do not apply, and significant_digits and engine must not be
+                     set.
             add_latlon: add lon and lat 2D arrays to the dataset
             add_latlon_bnds: add lon_bnds and lat_bnds 2D arrays to the dataset
-            x_chunk_size: size of chunking in the x-dimension
-            y_chunk_size: size of chunking in the x-dimension
-            time_chunk_size: size of chunking in the time dimension
+            x_chunk_size: size of chunking in the x-dimension, reduced if the dimension is smaller, and adjusted by
+                          up to 25% where that makes the chunks divide the dimension exactly
+            y_chunk_size: size of chunking in the y-dimension, reduced if the dimension is smaller, and adjusted by
+                          up to 25% where that makes the chunks divide the dimension exactly
+            time_chunk_size: size of chunking in the time dimension, reduced if the dimension is smaller
             custom_encodings: dictionary mapping from variable names to a custom encoding to use by xarray
-        """
+            override_encodings: dictionary mapping from variable names to settings which are added to (or, where the
+                                value is None, removed from) the standard encoding.  For example, to store a variable
+                                as 16 bit integers: {"distance": {"dtype": "int16", "scale_factor": 10.0,
+                                "_FillValue": -1}}.  Packing (dtype, scale_factor, add_offset and _FillValue) already
+                                present in a variable's encoding, for example when it was loaded from a file, is kept.
+            compression: the compression codec: "zlib", one of the other codecs supported by netCDF4 ("zstd", "bzip2",
+                         "szip", "blosc_lz", "blosc_lz4", "blosc_lz4hc", "blosc_zlib", "blosc_zstd") or None
+            complevel: the compression level
+            shuffle: apply the HDF5 shuffle filter before compressing variables with multi-byte data types, which
+                     usually improves compression of floating point data (the netCDF4 library only applies this with
+                     zlib compression).  Can be overridden per variable using override_encodings.
+            num_workers: the number of threads used to compute dask-backed variables, defaults to the dask default
+            engine: the xarray engine used to write the file, defaults to "netcdf4".  "h5netcdf" (which must be
+                    installed separately) releases the GIL while compressing, so that other threads can run
+            significant_digits: if set, quantize floating point variables to this many significant digits so that they
+                                compress much better (lossy), either an int applying to all floating point variables
+                                or a dictionary mapping from variable names to the number of digits to keep for each.
+                                Grid coordinate variables are never quantized.  Only supported by the netcdf4 engine.
+            quantize_mode: the netCDF4 quantization algorithm, "GranularBitRound", "BitGroom" or "BitRound" (for
+                           BitRound, significant_digits is the number of significant bits rather than decimal digits)
+            latlon_dtype: if set, the data type used to store lat, lon and their bounds (if included in the dataset),
+                          for example "float32" which is accurate to better than 1m and halves their size.  By default
+                          they are stored with the data type they already have.
+            persist: compute dask-backed variables into (possibly distributed) memory before writing the file, which
+                     lets the computation run across a dask cluster's workers before the write starts
 
-        encodings = {}
+        Raises:
+            ValueError: if the compression codec is not known, or if the netCDF4 library was built without it
+                        when writing with the netcdf4 engine, or if significant_digits or engine are set when
+                        saving to a Zarr store
 
-        for v in ds.variables:
-            if custom_encodings and v in custom_encodings:
-                encodings[v] = custom_encodings[v]
-            else:
-                dims = ds[v].dims
-                if "x" in dims and "y" in dims:
-
-                    encodings[v] = {
-                        "zlib": True,
-                        "complevel": 5
-                    }
-
-                    if v in override_encodings:
-                        for (name,value) in override_encodings[v].items():
-                            if value is None:
-                                if name in encodings:
-                                    del encodings[v][name]
-                            else:
-                                encodings[v][name] = value
-
-                    chunk_sizes = []
-                    for d in dims:
-                        if d == "y":
-                            chunk_sizes.append(y_chunk_size)
-                        elif d == "x":
-                            chunk_sizes.append(x_chunk_size)
-                        elif d == "time":
-                            chunk_sizes.append(time_chunk_size)
-                        else:
-                            chunk_sizes.append(0)
-                    encodings[v]["chunksizes"] = chunk_sizes
+        Notes:
+            zstd is usually much faster than zlib at a similar compression ratio, but readers of the file will need
+            netCDF-C 4.9 or later with the zstd filter plugin installed
 
+            add all variables to the dataset and save it once, rather than saving it repeatedly as variables are
+            added.  Dask-backed variables are rechunked to the chunks being written, so all variables are computed and
+            written together in a single pass.
+
+            lat and lon can always be recomputed from x, y and the crsOSGB grid mapping, so leaving them out of the
+            dataset saves a lot of space where many files are published on the same grid
+        """
+
+        if CHUKDataSetUtils.__is_zarr_path(to_path):
+            if significant_digits is not None or engine is not None:
+                raise ValueError("significant_digits and engine are not supported when saving to a Zarr store")
+            self.save_zarr(ds, to_path, add_latlon=add_latlon, add_latlon_bnds=add_latlon_bnds,
+                           x_chunk_size=x_chunk_size, y_chunk_size=y_chunk_size, time_chunk_size=time_chunk_size,
+                           custom_encodings=custom_encodings, override_encodings=override_encodings,
+                           num_workers=num_workers, latlon_dtype=latlon_dtype, persist=persist)
+            return
+
+        # add lat/lon before working out the encodings, so that they are chunked and compressed like other variables
         self.extend_latlon(ds, add_latlon=add_latlon, add_latlon_bnds=add_latlon_bnds)
 
+        encodings = CHUKDataSetUtils.create_encodings(ds, x_chunk_size=x_chunk_size, y_chunk_size=y_chunk_size,
+                                                      time_chunk_size=time_chunk_size,
+                                                      custom_encodings=custom_encodings,
+                                                      override_encodings=override_encodings, compression=compression,
+                                                      complevel=complevel, shuffle=shuffle, engine=engine,
+                                                      significant_digits=significant_digits,
+                                                      quantize_mode=quantize_mode, latlon_dtype=latlon_dtype)
 
         # ds = ds.rio.write_crs("EPSG:27700",grid_mapping_name="crsOSGB")
 
-        ds.to_netcdf(to_path, encoding=encodings)
+        ds = self.__rechunk(ds, {v: encoding["chunksizes"] for (v, encoding) in encodings.items()
+                                 if "chunksizes" in encoding})
+        if persist:
+            ds = ds.persist()
+
+        # a file which is still open for reading (for example as a mask or grid) cannot be overwritten
+        close_cached_dataset(to_path)
+        write = ds.to_netcdf(to_path, encoding=encodings, compute=False, engine=engine)
+        self.__compute(write, num_workers)
+
+    @staticmethod
+    def create_encodings(ds: xarray.Dataset, x_chunk_size: int = DEFAULT_X_CHUNK_SIZE,
+                         y_chunk_size: int = DEFAULT_Y_CHUNK_SIZE, time_chunk_size: int = DEFAULT_TIME_CHUNK_SIZE,
+                         custom_encodings: dict = {}, override_encodings: dict = {}, compression: str = "zlib",
+                         complevel: int = DEFAULT_COMPLEVEL, shuffle: bool = True, engine: str = None,
+                         significant_digits: [int, dict] = None, quantize_mode: str = "GranularBitRound",
+                         latlon_dtype: str = None) -> dict:
+        """
+        Work out the standard NetCDF4 chunking and compression encodings used by save() for a CHUK dataset
+
+        Args:
+            ds: an xarray dataset containing CHUK data
+            other arguments: as for save()
+
+        Returns:
+            a dictionary mapping from variable names to encodings, which can be passed to xarray.Dataset.to_netcdf
+
+        Raises:
+            ValueError: if the compression codec is not known, or if the netCDF4 library was built without it
+                        when writing with the netcdf4 engine
+        """
+        if compression is not None and compression != "zlib":
+            if compression not in CHUKDataSetUtils.NETCDF4_CODECS:
+                raise ValueError(f"unknown compression {compression}")
+            if engine in (None, "netcdf4"):
+                import netCDF4
+                if not getattr(netCDF4, CHUKDataSetUtils.NETCDF4_CODECS[compression], False):
+                    raise ValueError(f"{compression} compression is not supported by the installed netCDF4 library")
+
+        if compression is None:
+            compression_encoding = {}
+        elif compression == "zlib":
+            # use the older form of the encoding, understood by all netCDF4 versions
+            compression_encoding = {"zlib": True, "complevel": complevel}
+        else:
+            compression_encoding = {"compression": compression, "complevel": complevel}
+        if significant_digits is None:
+            quantize_digits = {}
+        elif isinstance(significant_digits, dict):
+            quantize_digits = significant_digits
+        else:
+            quantize_digits = {v: significant_digits for v in ds.variables if v not in CHUKDataSetUtils.GRID_VARIABLES}
+
+        encodings = {v: encoding for (v, encoding) in custom_encodings.items() if v in ds.variables}
+
+        variable_chunk_sizes = CHUKDataSetUtils.__get_chunk_sizes(ds, x_chunk_size, y_chunk_size, time_chunk_size)
+        for (v, chunk_sizes) in variable_chunk_sizes.items():
+            if v not in encodings:
+
+                variable = ds.variables[v]
+                # keep any packing of the variable, for example from the file it was loaded from
+                encodings[v] = {name: value for (name, value) in variable.encoding.items()
+                                if name in CHUKDataSetUtils.PACKING_ENCODINGS}
+                encodings[v].update(compression_encoding)
+                if latlon_dtype is not None and v in ("lat", "lon", "lat_bnds", "lon_bnds"):
+                    encodings[v]["dtype"] = latlon_dtype
+                stored_dtype = np.dtype(encodings[v].get("dtype", variable.dtype))
+                if compression_encoding:
+                    # shuffling single byte data has no effect
+                    encodings[v]["shuffle"] = shuffle and stored_dtype.itemsize > 1
+
+                CHUKDataSetUtils.__apply_override_encodings(encodings[v], override_encodings.get(v, {}))
+
+                encodings[v]["chunksizes"] = chunk_sizes
+
+                # only quantize variables which are stored as floating point
+                if v in quantize_digits and np.dtype(encodings[v].get("dtype", stored_dtype)).kind == "f":
+                    encodings[v]["significant_digits"] = quantize_digits[v]
+                    encodings[v]["quantize_mode"] = quantize_mode
+
+        return encodings
+
+    def save_zarr(self, ds: xarray.Dataset, to_path: [str, os.PathLike], add_latlon: bool = False,
+                  add_latlon_bnds: bool = False,
+                  x_chunk_size: int = DEFAULT_X_CHUNK_SIZE, y_chunk_size: int = DEFAULT_Y_CHUNK_SIZE,
+                  time_chunk_size: int = DEFAULT_TIME_CHUNK_SIZE,
+                  custom_encodings: dict = {}, override_encodings: dict = {}, num_workers: int = None,
+                  latlon_dtype: str = None, persist: bool = False):
+        """
+        Save a CHUK dataset to a Zarr store, applying the standard chunking
+
+        Args:
+            ds: an xarray dataset containing CHUK data
+            to_path: path to the Zarr store to create, any existing store at this path is overwritten
+            add_latlon: add lon and lat 2D arrays to the dataset
+            add_latlon_bnds: add lon_bnds and lat_bnds 2D arrays to the dataset
+            x_chunk_size: size of chunking in the x-dimension, reduced if the dimension is smaller, and adjusted by
+                          up to 25% where that makes the chunks divide the dimension exactly
+            y_chunk_size: size of chunking in the y-dimension, reduced if the dimension is smaller, and adjusted by
+                          up to 25% where that makes the chunks divide the dimension exactly
+            time_chunk_size: size of chunking in the time dimension, reduced if the dimension is smaller
+            custom_encodings: dictionary mapping from variable names to a custom encoding to use by xarray
+            override_encodings: dictionary mapping from variable names to settings which are added to (or, where the
+                                value is None, removed from) the standard encoding, as for save()
+            num_workers: the number of threads used to compute and write the chunks, defaults to the dask default
+            latlon_dtype: if set, the data type used to store lat, lon and their bounds (if included in the dataset),
+                          as for save().  By default they are stored with the data type they already have.
+            persist: compute dask-backed variables into (possibly distributed) memory before writing the store
+
+        Notes:
+            requires the zarr package.  Zarr stores are written one chunk at a time in parallel, and are usually the
+            faster format for cloud storage (for example AWS S3 or Google Cloud Storage) and for large scale
+            processing.  Compression uses zarr's default codec (zstd for Zarr format 3).
+        """
+        self.extend_latlon(ds, add_latlon=add_latlon, add_latlon_bnds=add_latlon_bnds)
+
+        encodings = {v: encoding for (v, encoding) in custom_encodings.items() if v in ds.variables}
+
+        for (v, chunk_sizes) in self.__get_chunk_sizes(ds, x_chunk_size, y_chunk_size, time_chunk_size).items():
+            if v not in encodings:
+                encodings[v] = {name: value for (name, value) in ds.variables[v].encoding.items()
+                                if name in CHUKDataSetUtils.PACKING_ENCODINGS}
+                if latlon_dtype is not None and v in ("lat", "lon", "lat_bnds", "lon_bnds"):
+                    encodings[v]["dtype"] = latlon_dtype
+                CHUKDataSetUtils.__apply_override_encodings(encodings[v], override_encodings.get(v, {}))
+                encodings[v]["chunks"] = chunk_sizes
+
+        # zarr compresses each chunk independently, so in-memory variables are split into chunks as well, allowing
+        # them to be compressed and written in parallel
+        ds = self.__rechunk(ds, {v: encoding["chunks"] for (v, encoding) in encodings.items() if "chunks" in encoding},
+                            include_in_memory=True)
+        if persist:
+            ds = ds.persist()
+
+        close_cached_dataset(to_path)
+        write = ds.to_zarr(to_path, encoding=encodings, mode="w", compute=False)
+        self.__compute(write, num_workers)
+
+    @staticmethod
+    def __get_chunk_sizes(ds: xarray.Dataset, x_chunk_size: int, y_chunk_size: int,
+                          time_chunk_size: int) -> dict:
+        # work out the chunk sizes to use for each variable organised by (y,x), other dimensions (for example bounds)
+        # are stored whole in each chunk.  chunk sizes must not exceed the size of each dimension
+        dim_chunk_sizes = {
+            "y": CHUKDataSetUtils.__fit_chunk_size(y_chunk_size, ds.sizes.get("y", y_chunk_size)),
+            "x": CHUKDataSetUtils.__fit_chunk_size(x_chunk_size, ds.sizes.get("x", x_chunk_size)),
+            "time": min(time_chunk_size, ds.sizes.get("time", time_chunk_size))
+        }
+        # variables tend to share a handful of dimension layouts, compute the chunk sizes once per layout
+        chunk_layouts = {}
+        chunk_sizes = {}
+        for (v, variable) in ds.variables.items():
+            dims = variable.dims
+            if "x" in dims and "y" in dims:
+                if dims not in chunk_layouts:
+                    chunk_layouts[dims] = tuple(dim_chunk_sizes.get(d, ds.sizes[d]) for d in dims)
+                # leave the chunking of variables with an empty dimension to the backend
+                if min(chunk_layouts[dims]) > 0:
+                    chunk_sizes[v] = chunk_layouts[dims]
+        return chunk_sizes
+
+    @staticmethod
+    def __is_zarr_path(path: [str, os.PathLike]) -> bool:
+        # paths may be strings or path-like objects such as pathlib.Path, and Zarr store paths may end with a /
+        return os.fspath(path).rstrip("/").endswith(".zarr")
+
+    @staticmethod
+    def __apply_override_encodings(encoding: dict, overrides: dict):
+        # add settings to an encoding, removing those whose value is None
+        for (name, value) in overrides.items():
+            if value is None:
+                encoding.pop(name, None)
+            else:
+                encoding[name] = value
 
-    def extend_latlon(self, ds, add_latlon=False, add_latlon_bnds=False):
+    @staticmethod
+    def __fit_chunk_size(chunk_size: int, dimension_size: int) -> int:
+        # prefer the closest chunk size within 25% of the requested size which divides the dimension exactly,
+        # avoiding a strip of small chunks at the edge of the grid
+        if chunk_size >= dimension_size:
+            return dimension_size
+        for delta in range(0, chunk_size // 4 + 1):
+            for candidate in (chunk_size + delta, chunk_size - delta):
+                if candidate > 0 and dimension_size % candidate == 0:
+                    return candidate
+        return chunk_size
+
+    @staticmethod
+    def __rechunk(ds: xarray.Dataset, chunk_sizes: dict, include_in_memory: bool = False) -> xarray.Dataset:
+        # rechunk dask-backed variables (and optionally in-memory variables) to match the chunks that will be written,
+        # so that blocks can be computed in parallel and each is written to exactly one chunk of the file
+        rechunk = {}
+        for (v, sizes) in chunk_sizes.items():
+            variable = ds.variables.get(v)
+            if variable is not None and (include_in_memory or variable.chunks is not None):
+                rechunk[v] = dict(zip(variable.dims, sizes))
+        if rechunk:
+            ds = ds.copy(deep=False)
+            for (v, chunks) in rechunk.items():
+                ds[v] = ds[v].chunk(chunks)
+        return ds
+
+    @staticmethod
+    def __compute(write, num_workers: int = None):
+        if num_workers is not None:
+            write.compute(scheduler="threads", num_workers=num_workers)
+        else:
+            write.compute()
+
+    def extend_latlon(self, ds: xarray.Dataset, add_latlon: bool = False,
+                      add_latlon_bnds: bool = False) -> xarray.Dataset:
+        """
+        Add lat/lon arrays and/or their bounds from the reference grid
+
+        Args:
+            ds: the dataset to mondify in-place
+            add_latlon: add lon and lat 2D arrays to the dataset
+            add_latlon_bnds: add lon_bnds and lat_bnds 2D arrays to the dataset
+
+        Returns:
+            the modified dataset
+        """
         if add_latlon:
             self.add_latlon(ds)
 
@@ -410,16 +826,21 @@ class CHUKDataSetUtils:
         if add_latlon:
             for v in ["lat", "lon"]:
                 # remove bounds if no such variable exists
-                bounds = ds[v].attrs.get("bounds",None)
+                attrs = ds.variables[v].attrs
+                bounds = attrs.get("bounds",None)
                 if bounds and bounds not in ds.variables:
-                    del ds[v].attrs["bounds"]
+                    del attrs["bounds"]
 
-    def check(self, ds: xarray.Dataset) -> ([(str, str)], [(str, str)]):
+        return ds
+
+    def check(self, ds: xarray.Dataset, check_coords: bool = False) -> ([(str, str)], [(str, str)]):
         """
         Check a dataset against CHUK format, returning details of any problems found
 
         Args:
             ds: the xarray.Dataset to check
+            check_coords: also check that the x and y coordinate values match the grid, by default only the
+                          dimension sizes (which are known without reading any data) are checked
 
         Returns:
             2-tuple (warnings, errors) containing lists of (code,detail) tuples
@@ -429,11 +850,17 @@ class CHUKDataSetUtils:
         warnings, errors = CHUKMetadata.check(ds)
 
         # check the dimensions are correct, compared to the grid
-        for v in ["x", "y"]:
-            actual_shape = ds[v].shape
-            expected_shape = self.chuk_grid_ds[v].shape
-            if actual_shape != expected_shape:
-                errors.append(("bad_shape", (v, actual_shape, expected_shape)))
+        sizes = ds.sizes
+        if tuple(sizes.get(d) for d in self._expected_sizes) != self._expected_size_values:
+            for (d, expected_size) in self._expected_sizes.items():
+                actual_size = sizes.get(d)
+                if actual_size != expected_size:
+                    actual_shape = () if actual_size is None else (actual_size,)
+                    errors.append(("bad_shape", (d, actual_shape, (expected_size,))))
+        elif check_coords:
+            for d in ("x", "y"):
+                if d in ds.variables and not np.allclose(ds[d].values, self._grid_variables[d].values):
+                    errors.append(("bad_coordinates", d))
 
         return warnings, errors
 
@@ -447,35 +874,58 @@ class CHUKDataSetUtils:
             to_resolution: the resolution for the sampled output, must be a multiple of 100
 
         Returns:
-            A dataset containing the sampled data
+            A dataset containing every (to_resolution/100)th cell in each dimension, starting with the first
         """
         if to_resolution % 100 != 0:
             raise ValueError(f"Error - resolution requested ({to_resolution}) is not a multiple of 100")
         sample_step = int(to_resolution / 100)
-        return ds.isel(x=slice(0, -1, sample_step), y=slice(0, -1, sample_step))
-
-    def add_latlon(self, ds: xarray.Dataset):
+        sampled = ds.isel(x=slice(None, None, sample_step), y=slice(None, None, sample_step))
+        if sample_step > 1:
+            # sampling leaves dask chunks sample_step times smaller, merge them back to the size of the input chunks
+            for (v, variable) in ds.variables.items():
+                if variable.chunks is not None:
+                    sampled[v] = sampled[v].chunk({d: c[0] for (d, c) in zip(variable.dims, variable.chunks)
+                                                   if d in ("y", "x")})
+        return sampled
+
+    def add_latlon(self, ds: xarray.Dataset) -> xarray.Dataset:
         """
         Add lat and lon 2D arrays from the reference grid
 
         Args:
             ds: the dataset to mondify in-place
+
+        Returns:
+            the modified dataset
+
+        Notes:
+            the arrays are read lazily from the grid file, adding them does not copy any data
         """
-        ds["lon"] = self.chuk_grid_ds["lon"]
-        ds["lat"] = self.chuk_grid_ds["lat"]
+        # add both arrays in a single update, which aligns and merges them with the dataset once
+        ds.update({"lon": self._lon, "lat": self._lat})
+        return ds
 
-    def add_latlon_bnds(self, ds: xarray.Dataset):
+    def add_latlon_bnds(self, ds: xarray.Dataset) -> xarray.Dataset:
         """
         Add lat and lon 2D bounds from the reference grid
 
         Args:
            ds: the dataset to mondify in-place
+
+        Returns:
+            the modified dataset
+
+        Raises:
+            ValueError: if the grid file does not contain the bounds
         """
-        ds["lon_bnds"] = self.chuk_grid_ds["lon_bnds"]
-        ds["lat_bnds"] = self.chuk_grid_ds["lat_bnds"]
+        if self._lon_bnds is None or self._lat_bnds is None:
+            raise ValueError("the grid file does not contain lon_bnds and lat_bnds")
+        ds.update({"lon_bnds": self._lon_bnds, "lat_bnds": self._lat_bnds})
+        return ds
 
     @staticmethod
-    def save_as_geotif(ds: xarray.Dataset, variable_name: str, to_path: str):
+    def save_as_geotif(ds: xarray.Dataset, variable_name: str, to_path: str, cloud_optimized: bool = True,
+                       compress: str = "DEFLATE", dtype: str = None):
         """
         Save a CHUK dataset to a geotiff
 
@@ -483,18 +933,33 @@ class CHUKDataSetUtils:
             ds: the CHUK dataset
             variable_name: the name of the variable to save from the dataset
             to_path: the path to save the geotiff file to
-        """
-        ds_crs = ds.rio.write_crs("EPSG:27700")
-        if "grid_mapping" in ds_crs[variable_name].attrs:
-            # this seems to cause a problem, why?
-            del ds_crs[variable_name].attrs["grid_mapping"]
-        tags = CHUKMetadata.to_json(ds_crs, variable_name)
-        ds_crs[variable_name].rio.to_raster(to_path, tags=tags)
+            cloud_optimized: write a Cloud Optimized GeoTIFF (tiled, with overviews), set to False for a plain geotiff
+            compress: the GDAL compression to apply, for example "DEFLATE", "ZSTD" (if supported by GDAL) or "NONE"
+            dtype: the data type to write, for example "float32" to halve the size of a float64 variable, defaults to
+                   the data type of the variable
 
-    def __extend_attrs(self, attrs, key, value, required=None):
-        if required and value == "" or value is None:
-            raise ValueError(f"attribute {key} is required")
+        Notes:
+            Cloud Optimized GeoTIFFs are usually much smaller and faster to read than plain geotiffs, and are
+            readable by any geotiff reader.  Writing them requires GDAL 3.1 or later.
+        """
+        # work on a shallow copy of the variable with its own attributes, so that the caller's dataset is not modified
+        da = ds[variable_name].copy(deep=False)
+        # the grid_mapping attribute conflicts with the CRS written by rioxarray
+        da.attrs = {k: v for (k, v) in da.attrs.items() if k != "grid_mapping"}
+        # build the tags from the variable without its grid_mapping attribute
+        tags = {
+            "__variable__": {variable_name: CHUKMetadata.to_json_variable(da)},
+            "__dataset__": CHUKMetadata.to_json_dataset(ds)
+        }
+        da = da.rio.write_crs("EPSG:27700")
+        if cloud_optimized:
+            da.rio.to_raster(to_path, tags=tags, driver="COG", dtype=dtype, compress=compress, predictor="YES",
+                             blocksize=512, overview_resampling="average", num_threads="ALL_CPUS")
         else:
-            if value == "" or value is None:
-                return
-            attrs[key] = value
+            options = {}
+            if compress.upper() != "NONE":
+                # the floating point predictor works for floats, the horizontal differencing predictor for integers
+                options["predictor"] = 3 if np.dtype(dtype or da.dtype).kind == "f" else 2
+            # write tile by tile rather than loading the whole variable into memory
+            da.rio.to_raster(to_path, tags=tags, dtype=dtype, compress=compress, tiled=True, windowed=True,
+                             BIGTIFF="IF_SAFER", **options)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+#     API for managing EOCIS-CHUK data
+#
+#     Copyright (C) 2023  EOCIS and National Centre for Earth Observation (NCEO)
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import weakref
+
+import xarray as xr
+
+# xarray's default lock for reading netCDF4 files combines the netCDF-C and HDF5 locks, and the order in which a
+# combined lock acquires its parts is not fixed.  Reading input files while writing an output file from the same
+# dask graph can then deadlock, so inputs are read holding only the HDF5 lock (which writers also acquire).
+# The lock is defined in a private xarray module, if it is not found there fall back to xarray's default lock (None).
+try:
+    from xarray.backends.locks import HDF5_LOCK as READ_LOCK
+except ImportError:
+    READ_LOCK = None
+
+# opened datasets, keyed on (path, modification time, chunks, decode_coords).  The cache only holds weak references,
+# so a dataset (and its file handle) is closed as soon as the masks and CHUKDataSetUtils instances using it are gone
+_datasets = weakref.WeakValueDictionary()
+_datasets_lock = threading.Lock()
+
+
+def open_dataset_cached(path:str, chunks:[str,dict]="auto", decode_coords:[bool,str]=True) -> xr.Dataset:
+    """
+    Open a NetCDF4 file lazily, sharing the opened dataset between callers
+
+    Datasets are cached on the absolute path and modification time of the file, so a file that is
+    rewritten will be re-opened.  The returned dataset is shared and must not be modified in-place.  The cache
+    does not keep datasets open, a dataset is closed when the last caller holding a reference to it releases it.
+
+    Args:
+        path: path to the NetCDF4 file
+        chunks: chunking passed to xarray.open_dataset
+        decode_coords: passed to xarray.open_dataset
+
+    Returns:
+        an xarray.Dataset backed by dask arrays
+    """
+    abspath = os.path.abspath(path)
+    mtime = os.path.getmtime(abspath)
+    if isinstance(chunks, dict):
+        chunks = tuple(sorted(chunks.items()))
+    key = (abspath, mtime, chunks, decode_coords)
+    with _datasets_lock:
+        ds = _datasets.get(key)
+        if ds is None:
+            # forget datasets opened from an earlier version of the file
+            for stale_key in [k for k in _datasets.keys() if k[0] == abspath and k[1] != mtime]:
+                _datasets.pop(stale_key, None)
+            ds = xr.open_dataset(abspath, chunks=dict(chunks) if isinstance(chunks, tuple) else chunks,
+                                 decode_coords=decode_coords, lock=READ_LOCK)
+            _datasets[key] = ds
+    return ds
+
+
+def close_cached_dataset(path:str):
+    """
+    Close any datasets opened from a file by open_dataset_cached, before the file is overwritten
+
+    Args:
+        path: path to the file
+    """
+    abspath = os.path.abspath(path)
+    with _datasets_lock:
+        datasets = [_datasets.pop(k, None) for k in [k for k in _datasets.keys() if k[0] == abspath]]
+    for ds in datasets:
+        if ds is not None:
+            ds.close()
+
+
+def clear_dataset_cache():
+    """
+    Forget all datasets opened by open_dataset_cached
+
+    Datasets which are still referenced elsewhere stay open, others are closed when they are garbage collected.
+    """
+    with _datasets_lock:
+        _datasets.clear()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+#     API for managing EOCIS-CHUK data
+#
+#     Copyright (C) 2023  EOCIS and National Centre for Earth Observation (NCEO)
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import functools
+
+import numpy as np
+
+
+def build_lut(values:np.ndarray) -> np.ndarray:
+    """
+    Build a lookup table with an entry for every possible value of a 8 or 16 bit integer array
+
+    Args:
+        values: the integer values which should map to True
+
+    Returns:
+        a boolean numpy array, indexed by the values viewed as unsigned integers
+    """
+    lut = np.zeros(1 << (8*values.dtype.itemsize), dtype=bool)
+    lut[values.view(f"u{values.dtype.itemsize}")] = True
+    return lut
+
+
+def lookup_mask(a:np.ndarray, lut:np.ndarray) -> np.ndarray:
+    """
+    Map each value of a 8 or 16 bit integer array to True/False using a lookup table
+
+    Args:
+        a: the integer array
+        lut: the lookup table created by build_lut
+
+    Returns:
+        a boolean numpy array with the same shape as a
+    """
+    unsigned = a.view(f"u{a.dtype.itemsize}")
+    apply_lut = _lut_kernel()
+    if apply_lut is not None:
+        return apply_lut(unsigned, lut)
+    return lut[unsigned]
+
+
+@functools.lru_cache(maxsize=None)
+def _lut_kernel():
+    # numba is slow to import, so only import it (and load the compiled kernel) when a mask is first evaluated
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.guvectorize(["void(uint8[:], boolean[:], boolean[:])", "void(uint16[:], boolean[:], boolean[:])"],
+                       "(n),(k)->(n)", cache=True)
+    def apply_lut(a, lut, out):
+        for i in range(a.shape[0]):
+            out[i] = lut[a[i]]
+
+    return apply_lut
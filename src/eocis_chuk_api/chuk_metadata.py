@@ -17,12 +17,11 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import copy
 import numpy as np
 
 
 class CHUKMetadata:
-    expected_dataset_metadata_keys = {
+    expected_dataset_metadata_keys = frozenset({
         "title",
         "institution",
         "product_version",
@@ -32,10 +31,7 @@ class CHUKMetadata:
         "history",
         "references",
         "tracking_id",
-        "Conventions",
-        "product_version",
         "format_version",
-        "summary",
         "keywords",
         "id",
         "naming_authority",
@@ -63,43 +59,68 @@ class CHUKMetadata:
         "geospatial_lat_resolution",
         "geospatial_lon_resolution",
         "key_variables"
-    }
+    })
+
+    # the numpy scalar types usually found in attributes, which can be recognised without an isinstance check
+    __NUMPY_SCALAR_TYPES = frozenset({np.float32, np.float64, np.int8, np.int16, np.int32, np.int64,
+                                      np.uint8, np.uint16, np.uint32, np.uint64})
 
     @staticmethod
     def __decode4json(o):
-        if isinstance(o, dict):
-            for key in o:
-                o[key] = CHUKMetadata.__decode4json(o[key])
-            return o
-        elif isinstance(o, list):
-            for idx in range(len(o)):
-                o[idx] = CHUKMetadata.__decode4json(o[idx])
+        # build new containers rather than modifying o, which may be shared with a dataset's attributes
+        # check the exact types first, which is cheaper than isinstance, falling back to isinstance for numpy
+        # scalars and for subclasses of ndarray, dict and list
+        t = type(o)
+        if t is str:
             return o
-        elif isinstance(o, np.float32):
-            return float(o)
-        elif isinstance(o, np.int32) or isinstance(o, np.int16) or isinstance(o, np.int8):
-            return int(o)
+        elif t is dict:
+            return {key: CHUKMetadata.__decode4json(value) for (key, value) in o.items()}
+        elif t is list:
+            return [CHUKMetadata.__decode4json(item) for item in o]
+        elif t is np.ndarray:
+            # tolist already converts the elements to python types
+            return o.tolist()
+        elif t in CHUKMetadata.__NUMPY_SCALAR_TYPES or isinstance(o, np.generic):
+            # any numpy scalar
+            return o.item()
         elif isinstance(o, np.ndarray):
-            return CHUKMetadata.__decode4json(o.tolist())
+            return o.tolist()
+        elif isinstance(o, dict):
+            return {key: CHUKMetadata.__decode4json(value) for (key, value) in o.items()}
+        elif isinstance(o, list):
+            return [CHUKMetadata.__decode4json(item) for item in o]
         else:
             return o
 
     @staticmethod
-    def to_json(ds, for_variable):
-        variable_metadata = {}
-        da = ds[for_variable]
-        variable_metadata[for_variable] = copy.deepcopy(da.attrs)
-        metadata = {}
-        metadata["__variable__"] = variable_metadata
-        metadata["__dataset__"] = copy.deepcopy(ds.attrs)
-        return CHUKMetadata.__decode4json(metadata)
+    def to_json_variable(da):
+        # __decode4json builds new containers, so the attributes can be passed without copying them
+        return CHUKMetadata.__decode4json(da.attrs)
+
+    @staticmethod
+    def to_json_dataset(ds):
+        # the global attributes only
+        return CHUKMetadata.__decode4json(ds.attrs)
+
+    @staticmethod
+    def to_json(ds, for_variable=None):
+        # for_variable=None includes the attributes of every variable, read from ds.variables to avoid building a
+        # DataArray for each one
+        if for_variable is None:
+            variable_metadata = {name: CHUKMetadata.to_json_variable(variable)
+                                 for (name, variable) in ds.variables.items()}
+        else:
+            variable_metadata = {for_variable: CHUKMetadata.to_json_variable(ds.variables[for_variable])}
+        return {
+            "__variable__": variable_metadata,
+            "__dataset__": CHUKMetadata.to_json_dataset(ds)
+        }
 
     @staticmethod
     def check(ds):
-        warnings = []
+        # difference accepts any iterable of keys, so ds.attrs can be passed directly
+        missing = sorted(CHUKMetadata.expected_dataset_metadata_keys.difference(ds.attrs))
+        warnings = [("missing_global_attribute", key) for key in missing]
         errors = []
-        for key in CHUKMetadata.expected_dataset_metadata_keys:
-            if key not in ds.attrs:
-                warnings.append(("missing_global_attribute", key))
 
         return warnings, errors
@@ -18,6 +18,7 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import sys
 import argparse
 import requests
 
@@ -42,12 +43,24 @@ def main():
 
     if not os.path.exists(args.output_path):
         url = "https://gws-access.jasmin.ac.uk/public/nceo_uor/eocis-chuk/"+filename
-        r = requests.get(url, allow_redirects=True)
-        if r.ok:
-            with open(args.output_path,"wb") as f:
-                f.write(r.content)
-        else:
-            print(f"Failed to fetch URL from {url}")
+        # stream the file to disk in blocks, rather than holding all of it in memory
+        with requests.get(url, allow_redirects=True, stream=True) as r:
+            if r.ok:
+                # download to a temporary file so that an interrupted download is not mistaken for a complete file
+                part_path = args.output_path + ".part"
+                try:
+                    with open(part_path,"wb") as f:
+                        for block in r.iter_content(chunk_size=1024*1024):
+                            f.write(block)
+                except BaseException:
+                    # do not leave a partial download behind
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    raise
+                os.replace(part_path, args.output_path)
+            else:
+                # exit with a non-zero status so that scripts can detect the failure
+                sys.exit(f"Failed to fetch URL from {url}")
     else:
         print(f"File {args.output_path} already exists")
 
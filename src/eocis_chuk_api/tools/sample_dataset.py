@@ -22,6 +22,7 @@ import xarray as xr
 import argparse
 
 from eocis_chuk_api import CHUKDataSetUtils
+from eocis_chuk_api.chuk_file_cache import READ_LOCK
 
 
 def main():
@@ -34,9 +35,15 @@ def main():
 
     args = parser.parse_args()
 
-    ds_in = xr.open_dataset(args.input_path)
+    # open lazily using the file's own chunks, so that the input is read and sampled one chunk at a time
+    ds_in = xr.open_dataset(args.input_path, chunks={}, lock=READ_LOCK)
     ds_out = CHUKDataSetUtils.sample(ds_in,args.resolution)
-    ds_out.to_netcdf(args.output_path)
+
+    # compress and chunk the output in the same way as CHUKDataSetUtils.save, keeping any packing from the input's
+    # encoding.  The encoding is passed explicitly, as the rest of the input's encoding (for example its original
+    # shape) no longer applies to the sampled variables and would make xarray discard the chunk sizes.
+    encodings = CHUKDataSetUtils.create_encodings(ds_out)
+    ds_out.to_netcdf(args.output_path, encoding=encodings)
 
 
 if __name__ == '__main__':
@@ -17,38 +17,98 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
+import math
+
 import numpy as np
 import xarray as xr
 import uuid
 import os.path
 
+# based on haversine example
+# https://gist.github.com/rochacbruno/2883505
+RADIUS = 6371  # km
+
+
+@functools.lru_cache(maxsize=None)
+def _haversine_kernel():
+    # if numba is installed, compute the distances in a single pass without creating temporary arrays
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.vectorize(["float32(float32, float32, float32, float32)", "float64(float64, float64, float64, float64)"],
+                     cache=True)
+    def haversine(lat, lon, from_lat, from_lon):
+        dlat = math.radians(lat - from_lat)
+        dlon = math.radians(lon - from_lon)
+        a = math.sin(dlat / 2) * math.sin(dlat / 2) + math.cos(math.radians(lat)) \
+            * math.cos(math.radians(from_lat)) * math.sin(dlon / 2) * math.sin(dlon / 2)
+        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+        return RADIUS * c * 1000
+
+    return haversine
+
+
 class TestDataGenerator:
 
     def __init__(self, chuk_dataset_utils):
         self.chuk_dataset_utils = chuk_dataset_utils
 
-    def create_distances(self, from_lat, from_lon):
+    def create_distances(self, from_lat, from_lon, dtype=None, max_km=None):
         """
         Return a test CHUK dataset containing distances from a central point, in km
 
         :param utils: CHUKDatasetUtils instance
         :param from_lat: central point latitude
         :param from_lon: central point longitude
+        :param dtype: compute the distances using this floating point type, for example np.float32 which halves the
+                      memory used and is accurate to a few metres, defaults to the type of the grid's lat/lon arrays
+        :param max_km: if set, only compute distances for cells within this distance of the central point, other
+                       cells are set to NaN
 
         :return: xarray.Dataset
         """
         lats, lons = self.chuk_dataset_utils.get_grid_latlons()
+        if dtype is not None:
+            lats = lats.astype(dtype, copy=False)
+            lons = lons.astype(dtype, copy=False)
+            from_lat = dtype(from_lat)
+            from_lon = dtype(from_lon)
+
+        if max_km is None:
+            return TestDataGenerator.__haversine(lats, lons, from_lat, from_lon)
 
-        # based on haversine example
-        # https://gist.github.com/rochacbruno/2883505
-        radius = 6371  # km
+        # a degree of latitude is at least 110km, use this to find a box containing all cells within max_km, and only
+        # compute distances for the rows and columns of the grid which overlap that box
+        max_dlat = max_km / 110
+        max_lat = abs(from_lat) + max_dlat
+        max_dlon = max_km / (110 * math.cos(math.radians(max_lat))) if max_lat < 90 else 360
+        in_box = ((abs(lats - from_lat) <= max_dlat) & (abs(lons - from_lon) <= max_dlon)).values
+        rows = np.flatnonzero(in_box.any(axis=1))
+        cols = np.flatnonzero(in_box.any(axis=0))
+        if len(rows) == 0:
+            return xr.full_like(lats, np.nan)
+        window = {"y": slice(rows[0], rows[-1] + 1), "x": slice(cols[0], cols[-1] + 1)}
+        distances = TestDataGenerator.__haversine(lats.isel(window), lons.isel(window), from_lat, from_lon)
+        # pad the window back out to the full grid, restoring the grid coordinates which are padded with NaN
+        padding = {"y": (rows[0], lats.sizes["y"] - 1 - rows[-1]), "x": (cols[0], lats.sizes["x"] - 1 - cols[-1])}
+        return distances.where(distances <= max_km * 1000).pad(padding).assign_coords(lats.coords)
+
+    @staticmethod
+    def __haversine(lats, lons, from_lat, from_lon):
+        haversine = _haversine_kernel()
+        if haversine is not None:
+            return haversine(lats, lons, from_lat, from_lon)
 
-        dlat = np.radians(lats - from_lat)
-        dlon = np.radians(lons - from_lon)
-        a = np.sin(dlat / 2) * np.sin(dlat / 2) + np.cos(np.radians(lats)) \
-            * np.cos(np.radians(from_lat)) * np.sin(dlon / 2) * np.sin(dlon / 2)
+        lats_rad = np.radians(lats)
+        from_lat_rad = math.radians(from_lat)
+        sin_dlat = np.sin((lats_rad - from_lat_rad) / 2)
+        sin_dlon = np.sin(np.radians(lons - from_lon) / 2)
+        a = sin_dlat * sin_dlat + np.cos(lats_rad) * math.cos(from_lat_rad) * (sin_dlon * sin_dlon)
         c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-        return radius * c * 1000
+        return RADIUS * c * 1000
 
     @staticmethod
     def get_tmp_folder():
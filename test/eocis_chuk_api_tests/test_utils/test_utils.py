@@ -18,7 +18,10 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import functools
 import os.path
+import uuid
+import numpy as np
 import xarray
 
 from eocis_chuk_api import CHUKDataSetUtils
@@ -29,14 +32,53 @@ def download_test_file(to_local_folder, filename):
     if not os.path.exists(local_path):
         import requests
         url = "https://gws-access.jasmin.ac.uk/public/nceo_uor/eocis-chuk/test_files/"+filename
-        r = requests.get(url, allow_redirects=True)
-        if r.ok:
-            with open(local_path,"wb") as f:
-                f.write(r.content)
-        else:
-            raise Exception(f"Unable to download {url}")
+        with requests.get(url, allow_redirects=True, stream=True) as r:
+            if r.ok:
+                part_path = local_path + ".part"
+                try:
+                    with open(part_path,"wb") as f:
+                        for block in r.iter_content(chunk_size=1024*1024):
+                            f.write(block)
+                except BaseException:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    raise
+                os.replace(part_path, local_path)
+            else:
+                raise Exception(f"Unable to download {url}")
 
     return local_path
 
 
+@functools.lru_cache(maxsize=None)
+def get_grid_utils(to_local_folder, filename):
+    # download the grid once and share a single CHUKDataSetUtils instance between tests
+    return CHUKDataSetUtils(download_test_file(to_local_folder, filename))
 
+
+def get_tracking_id(name):
+    # a fixed tracking id for each test, so that repeated runs produce identical output files
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "https://eocis.org/chuk-api/tests/" + name))
+
+
+def create_small_grid_utils(to_local_folder, filename, width, height):
+    """
+    Create a small synthetic grid file, and return a CHUKDataSetUtils instance for it
+
+    :param to_local_folder: the folder to create the grid file in
+    :param filename: the name of the grid file to create
+    :param width: the size of the x dimension
+    :param height: the size of the y dimension
+    :return: CHUKDataSetUtils instance
+    """
+    grid_path = os.path.join(to_local_folder, filename)
+    x = np.arange(width) * 1000 + 500
+    y = np.arange(height)[::-1] * 1000 + 500
+    grid_ds = xarray.Dataset(coords={"x": x, "y": y})
+    grid_ds["x_bnds"] = xarray.DataArray(np.stack([x - 500, x + 500], axis=1), dims=("x", "nv"))
+    grid_ds["y_bnds"] = xarray.DataArray(np.stack([y - 500, y + 500], axis=1), dims=("y", "nv"))
+    grid_ds["crsOSGB"] = xarray.DataArray(np.int32(0), attrs={"grid_mapping_name": "transverse_mercator"})
+    grid_ds["lat"] = xarray.DataArray(np.linspace(50, 58, height)[:, None] + np.zeros((height, width)), dims=("y", "x"))
+    grid_ds["lon"] = xarray.DataArray(np.linspace(-6, 2, width)[None, :] + np.zeros((height, width)), dims=("y", "x"))
+    grid_ds.to_netcdf(grid_path)
+    return CHUKDataSetUtils(grid_path)
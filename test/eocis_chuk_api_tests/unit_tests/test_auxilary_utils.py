@@ -18,23 +18,21 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import gc
 import unittest
-import uuid
 import os
 import numpy as np
 import xarray as xr
 
 from eocis_chuk_api import CHUKAuxilaryUtils, CHUKDataSetUtils
 from eocis_chuk_api_tests.test_utils.test_data_generator import TestDataGenerator
-from eocis_chuk_api_tests.test_utils.test_utils import download_test_file
+from eocis_chuk_api_tests.test_utils.test_utils import download_test_file, get_grid_utils, get_tracking_id
 from eocis_chuk_api.chuk_auxilary_utils import Mask
 
 class TestAuxSupport(unittest.TestCase):
 
     def test_usage(self):
-        grid_path = download_test_file(TestDataGenerator.get_tmp_folder(),"EOCIS-CHUK-GRID-1000M-v1.0.nc")
-
-        utils = CHUKDataSetUtils(grid_path)
+        utils = get_grid_utils(TestDataGenerator.get_tmp_folder(), "EOCIS-CHUK-GRID-1000M-v1.0.nc")
 
         maxst_local_path = download_test_file(TestDataGenerator.get_tmp_folder(),"EOCIS-CHUK-L4-LST-LANDSAT_MAXST-1KM-2022-fv0.1.nc")
         landcover_local_path = download_test_file(TestDataGenerator.get_tmp_folder(),"EOCIS-AUXILARY-L4-LANDCOVER-MERGED-2023-1KM-fv1.0.nc")
@@ -63,15 +61,15 @@ class TestAuxSupport(unittest.TestCase):
         ds = utils.create_new_dataset(title="My Mask",
                                       product_version="1.0",
                                       summary="A mask",
-                                      tracking_id=str(uuid.uuid4()))
+                                      tracking_id=get_tracking_id("urban_mask"))
 
         urban_mask_path = os.path.join(TestDataGenerator.get_tmp_folder(),"urban_mask.nc")
         utils.add_variable(ds, data=landcover_urban_mask.to_array().data, variable_name="urban_or_suburban")
         utils.save(ds,urban_mask_path)
 
-        mean_woodland_max_temps = float(max_ds["ST"].where(landcover_woodland_mask.to_array(),np.nan).mean(skipna=True))
-        mean_urban_max_temps = float(max_ds["ST"].where(landcover_urban_mask.to_array(), np.nan).mean(skipna=True))
-        mean_freshwater_max_temps = float(max_ds["ST"].where(landcover_freshwater_mask.to_array(), np.nan).mean(skipna=True))
+        mean_woodland_max_temps = CHUKAuxilaryUtils.masked_mean(max_ds["ST"], landcover_woodland_mask)
+        mean_urban_max_temps = CHUKAuxilaryUtils.masked_mean(max_ds["ST"], landcover_urban_mask)
+        mean_freshwater_max_temps = CHUKAuxilaryUtils.masked_mean(max_ds["ST"], landcover_freshwater_mask)
 
         self.assertEqual(302, int(mean_woodland_max_temps))
         self.assertEqual(312,int(mean_urban_max_temps))
@@ -102,3 +100,126 @@ class TestAuxSupport(unittest.TestCase):
         not_mask = CHUKAuxilaryUtils.not_mask(mm1)
         print(not_mask.to_array())
         self.assertTrue(np.array_equal(not_mask.to_array().data,np.array([[False,False],[True,True]])))
+
+    def test_combine_different_shapes(self):
+
+        class MockMask(Mask):
+
+            def __init__(self, data_array):
+                self.data_array = data_array
+
+            def to_array(self):
+                return self.data_array
+
+        rng = np.random.default_rng(2)
+        a_yx = rng.random((3, 4)) < 0.5
+        a_tyx = rng.random((2, 3, 4)) < 0.5
+        m_yx = MockMask(xr.DataArray(a_yx, dims=("y", "x")))
+        m_tyx = MockMask(xr.DataArray(a_tyx, dims=("time", "y", "x")))
+
+        # a (y,x) mask is broadcast against a (time,y,x) mask, whichever comes first
+        for (first, second) in [(m_yx, m_tyx), (m_tyx, m_yx)]:
+            or_mask = CHUKAuxilaryUtils.combine_masks_or(first, second).to_array()
+            self.assertTrue(np.array_equal((a_tyx | a_yx), or_mask.transpose("time", "y", "x").data))
+            and_mask = CHUKAuxilaryUtils.combine_masks_and(first, second).to_array()
+            self.assertTrue(np.array_equal((a_tyx & a_yx), and_mask.transpose("time", "y", "x").data))
+
+    def test_masked_mean_grid(self):
+        x = np.arange(4) * 1000 + 500
+        y = np.arange(3)[::-1] * 1000 + 500
+        ds = xr.Dataset(coords={"x": x, "y": y})
+        ds["category"] = xr.DataArray(np.array([[0, 1, 1, 0], [1, 0, 0, 1], [1, 1, 0, 0]], dtype=np.int8),
+                                      dims=("y", "x"),
+                                      attrs={"flag_values": np.array([0, 1], dtype=np.int8), "flag_meanings": "Sea Land"})
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "masked_mean_flags.nc")
+        ds.to_netcdf(path)
+        land_mask = CHUKAuxilaryUtils.create_mask(path, "category", mask_values="Land")
+
+        values = xr.DataArray(np.arange(12, dtype=np.float64).reshape((3, 4)), dims=("y", "x"),
+                              coords={"x": x, "y": y})
+        self.assertEqual(float(values.where(land_mask.to_array()).mean()),
+                         CHUKAuxilaryUtils.masked_mean(values, land_mask))
+
+        # a sub-window of the grid, or a variable on different coordinates, is rejected rather than masked by position
+        with self.assertRaises(ValueError):
+            CHUKAuxilaryUtils.masked_mean(values.isel(x=slice(1, 3)), land_mask)
+        with self.assertRaises(ValueError):
+            CHUKAuxilaryUtils.masked_mean(values.assign_coords(x=x + 1000), land_mask)
+
+    def test_small_integer_flags(self):
+        data = np.array([[-1, 0, 1], [2, -1, 1]], dtype=np.int8)
+        ds = xr.Dataset()
+        ds["category"] = xr.DataArray(data, dims=("y", "x"), attrs={
+            "flag_values": np.array([-1, 0, 1, 2], dtype=np.int8),
+            "flag_meanings": "Missing Sea Land_low Land_high"
+        })
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "small_integer_flags.nc")
+        ds.to_netcdf(path)
+
+        land_mask = CHUKAuxilaryUtils.create_mask(path, "category", mask_values="Land_*")
+        self.assertTrue(np.array_equal(land_mask.to_array().data, np.isin(data, [1, 2])))
+
+        missing_mask = CHUKAuxilaryUtils.create_mask(path, "category", mask_values="Missing")
+        self.assertEqual(2, missing_mask.count())
+
+    def test_many_mask_combinations(self):
+
+        class MockMask(Mask):
+
+            def __init__(self, data_array):
+                self.data_array = data_array
+
+            def to_array(self):
+                return self.data_array
+
+        rng = np.random.default_rng(1)
+        arrays = [rng.random((5, 7)) < 0.8 for _ in range(10)]
+        masks = [MockMask(xr.DataArray(a, dims=("y", "x"))) for a in arrays]
+
+        # up to 8 masks and more than 8 masks are combined differently
+        for n in [3, 8, 10]:
+            or_mask = CHUKAuxilaryUtils.combine_masks_or(*masks[:n])
+            self.assertTrue(np.array_equal(or_mask.to_array().data, np.any(arrays[:n], axis=0)))
+            and_mask = CHUKAuxilaryUtils.combine_masks_and(*masks[:n])
+            self.assertTrue(np.array_equal(and_mask.to_array().data, np.all(arrays[:n], axis=0)))
+
+    def test_rewrite_after_mask(self):
+        ds = xr.Dataset()
+        ds["category"] = xr.DataArray(np.array([[0, 1], [1, 0]], dtype=np.int8), dims=("y", "x"), attrs={
+            "flag_values": np.array([0, 1], dtype=np.int8),
+            "flag_meanings": "Sea Land"
+        })
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "rewritten_flags.nc")
+        ds.to_netcdf(path)
+
+        land_mask = CHUKAuxilaryUtils.create_mask(path, "category", mask_values="Land")
+        self.assertEqual(2, land_mask.count())
+
+        # once the mask is gone the file is no longer held open, so it can be rewritten
+        del land_mask
+        gc.collect()
+        ds["category"][0, 0] = 1
+        ds.to_netcdf(path)
+
+        land_mask = CHUKAuxilaryUtils.create_mask(path, "category", mask_values="Land")
+        self.assertEqual(3, land_mask.count())
+
+    def test_invalidate_stats(self):
+
+        class MockMask(Mask):
+
+            def __init__(self, data_array):
+                self.data_array = data_array
+
+            def to_array(self):
+                return self.data_array
+
+        mm = MockMask(xr.DataArray(np.array([[True, True], [False, False]]), dims=("y", "x")))
+        self.assertEqual(2, mm.count())
+
+        # the statistics are cached until the mask is invalidated, even when the array is updated in-place
+        mm.data_array[1, 0] = True
+        self.assertEqual(2, mm.count())
+        mm.invalidate()
+        self.assertEqual(3, mm.count())
+        self.assertEqual(0.75, mm.fraction())
@@ -18,18 +18,36 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import unittest
-import uuid
 import os
+import multiprocessing
+import pathlib
+import netCDF4
+import numpy as np
+import xarray as xr
 
 from eocis_chuk_api import CHUKDataSetUtils
 from eocis_chuk_api_tests.test_utils.test_data_generator import TestDataGenerator
-from eocis_chuk_api_tests.test_utils.test_utils import download_test_file
+from eocis_chuk_api_tests.test_utils.test_utils import get_grid_utils, get_tracking_id, create_small_grid_utils
+
+
+def save_derived_dataset(grid_path, input_path, output_path):
+    """
+    Load a dataset lazily, and save a dataset computed from it using several threads
+
+    :param grid_path: path to the grid file
+    :param input_path: path to the dataset to load
+    :param output_path: path to save the derived dataset to
+    """
+    utils = CHUKDataSetUtils(grid_path)
+    loaded = utils.load(input_path, chunks={})
+    derived = xr.Dataset({"doubled": loaded["v"] * 2, "halved": loaded["v"] / 2})
+    utils.save(derived, output_path, x_chunk_size=20, y_chunk_size=20, num_workers=4)
+
 
 class TestDatasetCreation(unittest.TestCase):
 
     def test1(self):
-        grid_path = download_test_file(TestDataGenerator.get_tmp_folder(), "EOCIS-CHUK-GRID-1000M-v1.0.nc")
-        utils = CHUKDataSetUtils(grid_path)
+        utils = get_grid_utils(TestDataGenerator.get_tmp_folder(), "EOCIS-CHUK-GRID-1000M-v1.0.nc")
 
         gen = TestDataGenerator(utils)
         # Whitendale Hanging Stones is the centroid of Great Britain
@@ -38,7 +56,7 @@ class TestDatasetCreation(unittest.TestCase):
         ds = utils.create_new_dataset(title="Distance to the GB Centroid",
                                       product_version="1.0",
                                       summary="The distance in km using the haversine formula to each CHUK grid location from the centroid of Great Britain",
-                                      tracking_id=str(uuid.uuid4()),
+                                      tracking_id=get_tracking_id("distances"),
                                       spatial_resolution="1km",
                                       format_version="EOCIS Data Standards v0.4",
                                       key_variables="distance",
@@ -71,4 +89,200 @@ class TestDatasetCreation(unittest.TestCase):
         self.assertEqual(0, len(errors))
         filename = utils.create_filename("CHUK",processing_level="L4",product_type="TEST", product_string="UNITTEST", datetime="2024", version="1.0")
         tmp_folder = TestDataGenerator.get_tmp_folder()
-        utils.save(ds,os.path.join(tmp_folder,filename))
\ No newline at end of file
+        utils.save(ds,os.path.join(tmp_folder,filename))
+
+    def test_add_variable_dims(self):
+        # a small synthetic grid is enough to check how variables are laid out
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid.nc", 4, 3)
+
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.zeros((3, 4)), variable_name="v_yx")
+        utils.add_variable(ds, data=np.zeros((2, 3, 4)), variable_name="v_tyx")
+        utils.add_variable(ds, data=np.zeros((3, 4, 2)), variable_name="v_yxt")
+        self.assertEqual(("y", "x"), ds["v_yx"].dims)
+        self.assertEqual(("time", "y", "x"), ds["v_tyx"].dims)
+        self.assertEqual(("y", "x", "time"), ds["v_yxt"].dims)
+
+        for bad_shape in [(4, 3), (2, 4, 3), (3, 4, 5, 6), (4,)]:
+            with self.assertRaises(ValueError):
+                utils.add_variable(ds, data=np.zeros(bad_shape), variable_name="bad")
+
+    def test_create_new_dataset_attributes(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_attributes.nc", 4, 3)
+
+        # every global attribute argument is written, in the standard order, followed by any other attributes
+        values = {name: name + "_value" for name in CHUKDataSetUtils.GLOBAL_ATTRIBUTES}
+        ds = utils.create_new_dataset(**values, other="other_value")
+        self.assertEqual({**values, "other": "other_value"}, ds.attrs)
+        self.assertEqual(list(CHUKDataSetUtils.GLOBAL_ATTRIBUTES) + ["other"], list(ds.attrs))
+
+        # empty attributes are left out, unless they are required
+        ds = utils.create_new_dataset(title="t", product_version="1.0", tracking_id="id", project="")
+        self.assertNotIn("project", ds.attrs)
+        self.assertNotIn("source", ds.attrs)
+        with self.assertRaises(ValueError):
+            utils.create_new_dataset(title="", product_version="1.0", tracking_id="id")
+
+    def test_save_zarr_options(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_zarr_options.nc", 50, 40)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.linspace(0, 100, 2000).reshape((40, 50)), variable_name="distance")
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "zarr_options.zarr")
+
+        # packing and the lat/lon data type are applied to Zarr stores as well as NetCDF4 files
+        utils.save(ds, path, add_latlon=True, latlon_dtype="float32",
+                   override_encodings={"distance": {"dtype": "int16", "scale_factor": 0.01, "_FillValue": -1}})
+        saved = xr.open_zarr(path)
+        self.assertEqual(np.int16, saved["distance"].encoding["dtype"])
+        self.assertEqual(np.float32, saved["lat"].encoding["dtype"])
+        self.assertTrue(np.allclose(ds["distance"].values, saved["distance"].values, atol=0.005))
+
+        # options which only apply to NetCDF4 files are rejected
+        with self.assertRaises(ValueError):
+            utils.save(ds, path, significant_digits=3)
+
+    def test_save_derived_dataset(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_derived.nc", 200, 100)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.random.default_rng(0).random((100, 200)), variable_name="v")
+        tmp_folder = TestDataGenerator.get_tmp_folder()
+        grid_path = os.path.join(tmp_folder, "small_grid_derived.nc")
+        input_path = os.path.join(tmp_folder, "derived_input.nc")
+        utils.save(ds, input_path, x_chunk_size=20, y_chunk_size=20)
+
+        # read the input while writing the output from the same dask graph, using several threads.  With xarray's
+        # default read lock this deadlocks intermittently, usually on the first save in a process, so save in several
+        # new processes which can be stopped if they hang
+        context = multiprocessing.get_context("spawn")
+        output_paths = [os.path.join(tmp_folder, f"derived_output_{i}.nc") for i in range(4)]
+        save_processes = [context.Process(target=save_derived_dataset, args=(grid_path, input_path, output_path))
+                          for output_path in output_paths]
+        for save_process in save_processes:
+            save_process.start()
+        for save_process in save_processes:
+            save_process.join(timeout=120)
+        hung = [save_process for save_process in save_processes if save_process.is_alive()]
+        for save_process in hung:
+            save_process.terminate()
+        self.assertEqual(0, len(hung), "save did not complete")
+        self.assertEqual([0] * len(save_processes), [save_process.exitcode for save_process in save_processes])
+
+        for output_path in output_paths:
+            saved = xr.load_dataset(output_path)
+            self.assertTrue(np.allclose(ds["v"].values * 2, saved["doubled"].values))
+            self.assertTrue(np.allclose(ds["v"].values / 2, saved["halved"].values))
+
+    def test_save_chunk_sizes(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_chunks.nc", 30, 40)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.random.default_rng(0).random((40, 30)), variable_name="v")
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "chunk_sizes.nc")
+
+        # chunk sizes are adjusted to divide each dimension exactly, 16 becomes 20 for 40 cells and 15 for 30 cells
+        utils.save(ds, path, x_chunk_size=16, y_chunk_size=16)
+        with netCDF4.Dataset(path) as nc:
+            self.assertEqual([20, 15], nc.variables["v"].chunking())
+            self.assertTrue(nc.variables["v"].filters()["zlib"])
+            self.assertEqual(5, nc.variables["v"].filters()["complevel"])
+
+        # chunk sizes larger than a dimension are reduced to its size
+        utils.save(ds, path, x_chunk_size=100, y_chunk_size=100)
+        with netCDF4.Dataset(path) as nc:
+            self.assertEqual([40, 30], nc.variables["v"].chunking())
+
+    def test_save_latlon_dtype(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_latlon.nc", 30, 40)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.zeros((40, 30)), variable_name="v")
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "latlon_dtype.nc")
+
+        # lat/lon keep the grid's data type unless a smaller type is requested
+        utils.save(ds, path, add_latlon=True)
+        with netCDF4.Dataset(path) as nc:
+            self.assertEqual(np.float64, nc.variables["lat"].dtype)
+        utils.save(ds, path, add_latlon=True, latlon_dtype="float32")
+        with netCDF4.Dataset(path) as nc:
+            self.assertEqual(np.float32, nc.variables["lat"].dtype)
+            self.assertTrue(np.allclose(utils.get_grid_latlons()[0].values, nc.variables["lat"][:], atol=1e-5))
+
+    def test_save_compression_options(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_compression.nc", 30, 40)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.random.default_rng(0).random((40, 30)), variable_name="v")
+        utils.add_variable(ds, data=np.arange(1200, dtype=np.int32).reshape((40, 30)), variable_name="i")
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "compression_options.nc")
+
+        utils.save(ds, path, compression=None)
+        with netCDF4.Dataset(path) as nc:
+            self.assertFalse(nc.variables["v"].filters()["zlib"])
+
+        with self.assertRaises(ValueError):
+            utils.save(ds, path, compression="unknown")
+
+        # only floating point variables are quantized
+        utils.save(ds, path, significant_digits=3)
+        with netCDF4.Dataset(path) as nc:
+            self.assertEqual(3, nc.variables["v"].quantization()[0])
+            self.assertIsNone(nc.variables["i"].quantization())
+        saved = xr.load_dataset(path)
+        self.assertFalse(np.array_equal(ds["v"].values, saved["v"].values))
+        self.assertTrue(np.allclose(ds["v"].values, saved["v"].values, rtol=5e-3, atol=0))
+        self.assertTrue(np.array_equal(ds["i"].values, saved["i"].values))
+
+    def test_save_load_zarr(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_zarr.nc", 30, 40)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.random.default_rng(0).random((40, 30)), variable_name="v")
+        path = os.path.join(TestDataGenerator.get_tmp_folder(), "save_load.zarr")
+
+        utils.save_zarr(ds, path, add_latlon=True, x_chunk_size=16, y_chunk_size=16)
+        loaded = utils.load(path, chunks={})
+        self.assertEqual(((20, 20), (15, 15)), loaded["v"].chunks)
+        self.assertTrue(np.array_equal(ds["v"].values, loaded["v"].values))
+        self.assertIn("lat", loaded)
+
+    def test_save_load_pathlib(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_pathlib.nc", 30, 40)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.random.default_rng(0).random((40, 30)), variable_name="v")
+        folder = pathlib.Path(TestDataGenerator.get_tmp_folder())
+
+        # paths can be pathlib.Path objects, for NetCDF4 files and Zarr stores
+        for path in [folder / "pathlib.nc", folder / "pathlib.zarr"]:
+            utils.save(ds, path)
+            self.assertTrue(np.array_equal(ds["v"].values, utils.load(path)["v"].values))
+        self.assertTrue((folder / "pathlib.zarr").is_dir())
+
+    def test_packing_kept(self):
+        utils = create_small_grid_utils(TestDataGenerator.get_tmp_folder(), "small_grid_packing.nc", 30, 40)
+        ds = xr.Dataset()
+        utils.add_variable(ds, data=np.linspace(0, 100, 1200).reshape((40, 30)), variable_name="distance")
+        packed_path = os.path.join(TestDataGenerator.get_tmp_folder(), "packed.nc")
+        resaved_path = os.path.join(TestDataGenerator.get_tmp_folder(), "packed_resaved.nc")
+
+        utils.save(ds, packed_path,
+                   override_encodings={"distance": {"dtype": "int16", "scale_factor": 0.01, "_FillValue": -1}})
+        # saving a loaded dataset keeps the packing it was loaded with
+        utils.save(utils.load(packed_path), resaved_path)
+        with netCDF4.Dataset(resaved_path) as nc:
+            self.assertEqual(np.int16, nc.variables["distance"].dtype)
+            self.assertEqual(0.01, nc.variables["distance"].scale_factor)
+        resaved = xr.load_dataset(resaved_path)
+        self.assertTrue(np.allclose(ds["distance"].values, resaved["distance"].values, atol=0.005))
+
+    def test_sample(self):
+        x = np.arange(7) * 100 + 50
+        y = np.arange(5)[::-1] * 100 + 50
+        ds = xr.Dataset(coords={"x": x, "y": y})
+        ds["v"] = xr.DataArray(np.arange(35).reshape((5, 7)), dims=("y", "x")).chunk({"y": 4, "x": 4})
+
+        # every second cell is sampled, including the last row and column
+        sampled = CHUKDataSetUtils.sample(ds, 200)
+        self.assertEqual([50, 250, 450, 650], list(sampled["x"].values))
+        self.assertEqual([450, 250, 50], list(sampled["y"].values))
+        self.assertTrue(np.array_equal(ds["v"].values[::2, ::2], sampled["v"].values))
+        # the sampled chunks are merged back to the size of the input chunks
+        self.assertEqual(((3,), (4,)), sampled["v"].chunks)
+
+        with self.assertRaises(ValueError):
+            CHUKDataSetUtils.sample(ds, 150)
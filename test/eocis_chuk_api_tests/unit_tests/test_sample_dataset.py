@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+#     API for managing EOCIS-CHUK data
+#
+#     Copyright (C) 2023  EOCIS and National Centre for Earth Observation (NCEO)
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+import os
+import sys
+from unittest import mock
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from eocis_chuk_api.tools import sample_dataset
+from eocis_chuk_api_tests.test_utils.test_data_generator import TestDataGenerator
+
+
+class TestSampleDataset(unittest.TestCase):
+
+    def test_output_chunking(self):
+        tmp_folder = TestDataGenerator.get_tmp_folder()
+        input_path = os.path.join(tmp_folder, "sample_input.nc")
+        output_path = os.path.join(tmp_folder, "sample_output.nc")
+
+        ds = xr.Dataset(coords={"x": np.arange(2400) * 100 + 50, "y": np.arange(40)[::-1] * 100 + 50})
+        ds["v"] = xr.DataArray(np.full((2, 40, 2400), 1.5), dims=("time", "y", "x"))
+        ds.to_netcdf(input_path, encoding={"v": {"zlib": True, "chunksizes": (2, 40, 2400), "dtype": "int16",
+                                                 "scale_factor": 0.5}})
+
+        with mock.patch.object(sys, "argv", ["sample_dataset.py", input_path, output_path, "200"]):
+            sample_dataset.main()
+
+        # the sampled variable is written using the standard CHUK chunking and compression, the default x chunk size
+        # of 1000 is adjusted to 1200 to divide the dimension exactly, as in CHUKDataSetUtils.save
+        with netCDF4.Dataset(output_path) as nc:
+            v = nc.variables["v"]
+            self.assertEqual((2, 20, 1200), v.shape)
+            self.assertEqual([1, 20, 1200], v.chunking())
+            self.assertTrue(v.filters()["zlib"])
+            self.assertTrue(v.filters()["shuffle"])
+            # the packing of the input is kept
+            self.assertEqual(np.int16, v.dtype)
+            self.assertEqual(0.5, v.scale_factor)
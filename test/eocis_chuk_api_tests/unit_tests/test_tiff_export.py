@@ -17,20 +17,23 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import ast
 import unittest
 import os
-import uuid
+
+import numpy as np
+import rasterio
+import xarray as xr
 
 from eocis_chuk_api import CHUKDataSetUtils
 from eocis_chuk_api_tests.test_utils.test_data_generator import TestDataGenerator
-from eocis_chuk_api_tests.test_utils.test_utils import download_test_file
+from eocis_chuk_api_tests.test_utils.test_utils import get_grid_utils, get_tracking_id, create_small_grid_utils
 
 
 class TestTiffExport(unittest.TestCase):
 
     def test1(self):
-        grid_path = download_test_file(TestDataGenerator.get_tmp_folder(), "EOCIS-CHUK-GRID-1000M-v1.0.nc")
-        utils = CHUKDataSetUtils(grid_path)
+        utils = get_grid_utils(TestDataGenerator.get_tmp_folder(), "EOCIS-CHUK-GRID-1000M-v1.0.nc")
 
         gen = TestDataGenerator(utils)
         # Whitendale Hanging Stones is the centroid of Great Britain
@@ -39,7 +42,7 @@ class TestTiffExport(unittest.TestCase):
         ds = utils.create_new_dataset(title="Distance to the GB Centroid",
                                       product_version="1.0",
                                       summary="The distance in km using the haversine formula to each CHUK grid location from the centroid of Great Britain",
-                                      tracking_id=str(uuid.uuid4()))
+                                      tracking_id=get_tracking_id("tiff_export"))
 
         dists = gen.create_distances(54.0025, -2.5449)
         utils.add_variable(ds, variable_name="distances",
@@ -55,4 +58,27 @@ class TestTiffExport(unittest.TestCase):
         tmp_folder = TestDataGenerator.get_tmp_folder()
         utils.save_as_geotif(ds,"distances",os.path.join(tmp_folder,filename))
 
+        with rasterio.open(os.path.join(tmp_folder,filename)) as src:
+            tags = src.tags()
+        variable_tags = ast.literal_eval(tags["__variable__"])
+        self.assertEqual("km", variable_tags["distances"]["units"])
+        self.assertNotIn("grid_mapping", variable_tags["distances"])
+        self.assertEqual("Distance to the GB Centroid", ast.literal_eval(tags["__dataset__"])["title"])
+
+    def test_tags(self):
+        tmp_folder = TestDataGenerator.get_tmp_folder()
+        utils = create_small_grid_utils(tmp_folder, "small_grid_tiff.nc", 30, 40)
+        ds = xr.Dataset(attrs={"title": "Tags"})
+        utils.add_variable(ds, data=np.zeros((40, 30), dtype=np.float32), variable_name="v", units="K")
+        ds["v"].attrs["grid_mapping"] = "crsOSGB"
+        path = os.path.join(tmp_folder, "tags.tif")
+
+        utils.save_as_geotif(ds, "v", path, cloud_optimized=False)
 
+        # the variable's attributes are written as tags, apart from grid_mapping which is replaced by the CRS
+        with rasterio.open(path) as src:
+            tags = src.tags()
+        self.assertEqual({"v": {"units": "K"}}, ast.literal_eval(tags["__variable__"]))
+        self.assertEqual("Tags", ast.literal_eval(tags["__dataset__"])["title"])
+        # the caller's dataset is not modified
+        self.assertEqual("crsOSGB", ds["v"].attrs["grid_mapping"])